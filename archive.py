@@ -0,0 +1,23 @@
+"""command line tool to move old consumption entries into the compact per-day archive, e.g.
+
+    python archive.py --days 365 --file archive.sqlite3
+
+Without --file the archive table lives in db.sqlite3 itself."""
+
+import argparse
+import db
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="archive consumption entries older than a number of days")
+    parser.add_argument("--days", type=int, default=365, help="keep this many days of individual entries")
+    parser.add_argument("--file", default=None, help="separate database file to hold the archive")
+    args = parser.parse_args()
+
+    moved = db.archive_consumption(args.days, args.file)
+    print(f"archived {moved} consumption entries older than {args.days} days")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""in-memory copy of the per-day numbers the window shows, kept up to date from the change summaries the db
+module sends out after every write. Widgets subscribe to the kinds of change they display and are called
+back once per batch, so adding one entry re-renders each affected widget once rather than having every
+widget run its own queries."""
+
+import db
+
+
+class DayState:
+
+    def __init__(self, schedule=None):
+
+        """schedule is called with a function to run once the current burst of changes is over, in the app
+        this is the tk root's after_idle. Without one, subscribers are called straight away."""
+
+        self.schedule = schedule
+        self.totals = {}  # date: {protein, carbohydrate, fat, kcals}, for every day with entries
+        self.weights = {}  # date: {weight row id: weighin}
+        self.entries = {}  # date: {(table, row id): row}, only for days something has asked to see
+        self.subscribers = []  # (callback, topics)
+        self.pending = {}  # topic: set of dates changed since the last flush, (food name, date) pairs for "foods"
+        self.flush_scheduled = False
+        self.load()
+        db.add_listener(self.on_db_change)
+
+    def load(self):
+
+        self.totals = {}
+        self.weights = {}
+        self.entries = {}
+        for row in db.get_daily_totals():
+            if "date(entry_time)" in row.keys():
+                # an empty table gives back a single row of zeros with no date
+                self.totals[row["date(entry_time)"]] = {k: row[f"sum({k})"] for k in db.NUTRIENTS}
+        for row in db.get_daily_weighins():
+            self.weights.setdefault(row["date(entry_time)"], {})[row["id"]] = row["weighin"]
+
+    def reload(self):
+
+        """read everything in again, after switching to another profile. Every date either person has data
+        for is queued as changed so the widgets replace the old numbers."""
+
+        dates = set(self.totals) | set(self.weights) | set(self.entries)
+        self.load()
+        dates |= set(self.totals) | set(self.weights) | {db.today()}
+        for topic in ("totals", "weight", "entries"):
+            for date in dates:
+                self.queue(topic, date)
+
+    @staticmethod
+    def normalise_date(date):
+
+        """the UI asks for 'now' or passes datetime.date objects from the graph, the state is keyed on
+        YYYY-MM-DD strings"""
+
+        if date == "now":
+            return db.today()
+        return str(date)
+
+    def subscribe(self, callback, *topics):
+
+        """callback gets a dict of {topic: set of dates} covering only the given topics that changed. The
+        "foods" topic has (food name, date) pairs instead, for the consumption entries that changed."""
+
+        self.subscribers.append((callback, topics))
+
+    def day_totals(self, date):
+
+        return self.totals.get(self.normalise_date(date), {k: 0.0 for k in db.NUTRIENTS})
+
+    def day_weight(self, date):
+
+        """the most recent weigh-in on a date, or None"""
+
+        w = self.weights.get(self.normalise_date(date))
+        if not w:
+            return None
+        return w[max(w)]
+
+    def day_entries(self, date):
+
+        """consumption and weight rows for one day, read from the db the first time a day is asked for
+        and kept in step with changes after that"""
+
+        date = self.normalise_date(date)
+        if date not in self.entries:
+            food, weights = db.get_day_entries(date)
+            ent = {}
+            for table, rows in (("consumption", food), ("weight", weights)):
+                for row in rows:
+                    ent[(table, row["id"])] = dict(row)
+            self.entries[date] = ent
+        return self.entries[date]
+
+    def calorie_split(self, date):
+
+        rows = [x for (table, _), x in self.day_entries(date).items() if table == "consumption"]
+        if not rows:
+            # nothing live for this day, but it might have been archived
+            return db.get_day_consumption(self.normalise_date(date))
+        return db.condense_calorie_split(sorted(rows, key=lambda x: x["kcals"], reverse=True))
+
+    def on_db_change(self, change):
+
+        date = change["date"]
+        table = change["table"]
+        before, after = change["before"], change["after"]
+        if table == "consumption":
+            t = self.totals.setdefault(date, {k: 0.0 for k in db.NUTRIENTS})
+            for k in db.NUTRIENTS:
+                t[k] += change["delta"][k]
+            self.queue("totals", date)
+            for row in (before, after):
+                if row:
+                    self.queue("foods", (row["name"], db.day_to_date(row["entry_day"])))
+        else:
+            w = self.weights.setdefault(date, {})
+            if before:
+                w.pop(before["id"], None)
+            if after:
+                w[after["id"]] = after["weighin"]
+            self.queue("weight", date)
+
+        if date in self.entries:
+            ent = self.entries[date]
+            if before:
+                ent.pop((table, before["id"]), None)
+            if after:
+                ent[(table, after["id"])] = after
+        self.queue("entries", date)
+
+    def queue(self, topic, date):
+
+        self.pending.setdefault(topic, set()).add(date)
+        if self.schedule is None:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.schedule(self.flush)
+
+    def flush(self):
+
+        """call every subscriber whose topics changed, once, with everything that changed since last time"""
+
+        self.flush_scheduled = False
+        pending, self.pending = self.pending, {}
+        for callback, topics in self.subscribers:
+            changes = {t: pending[t] for t in topics if t in pending}
+            if changes:
+                callback(changes)
@@ -1,16 +1,154 @@
 import sqlite3
 import csv
+import json
+import datetime
+import os
+import contextlib
+import weakref
+import units
+import migrations
+
+
+CATALOGUE_PATH = "catalogue.sqlite3"  # once this exists the app runs with profiles, see connect()
+PROFILE_DIR = "profiles"
+DB_PATH = os.environ.get("CALORIE_DB")  # use this single database file instead, e.g. a test copy
+
+
+def log_schema(conn):
+
+    """the schema that holds the consumption and weight tables, "profile" when a profile is attached to the
+    catalogue and "main" otherwise. Unqualified table names find them either way, this is for the places
+    that name a schema or use a table that both files have, like settings and changelog."""
+
+    for row in conn.execute('''PRAGMA database_list'''):
+        if row["name"] == "profile":
+            return "profile"
+    return "main"
+
+
+def _setup_history(conn):
+
+    """attach the archive file if one has been set up and make the consumption_history view, which has
+    the live consumption rows and the archived per-day summaries together so queries over the whole
+    history don't need to know which rows have been archived"""
+
+    schema = log_schema(conn)
+    if not conn.execute(f'''SELECT 1 FROM {schema}.sqlite_master WHERE name = 'consumption' ''').fetchone():
+        return  # a catalogue on its own, nothing to show
+    row = conn.execute(f'''SELECT value FROM {schema}.settings WHERE key = ?''', ("archive_path",)).fetchone()
+    sources = [f"{schema}.consumption_archive"]
+    if row:
+        conn.execute('''ATTACH DATABASE ? AS archive''', (row["value"],))
+        conn.execute(migrations.ARCHIVE_TABLE.format(schema="archive"))
+        conn.execute(migrations.ARCHIVE_INDEX.format(schema="archive"))
+        sources.append("archive.consumption_archive")
+
+    parts = [f'''SELECT entry_day, name, amount, unit, protein, carbohydrate, fat, kcals, 1 AS entries
+                 FROM {schema}.consumption''']
+    for x in sources:
+        parts.append(f'''SELECT entry_day, name, amount, unit, protein, carbohydrate, fat, kcals, entries FROM {x}''')
+    conn.execute('''DROP VIEW IF EXISTS temp.consumption_history''')
+    conn.execute(f'''CREATE TEMP VIEW consumption_history AS {" UNION ALL ".join(parts)}''')
+
+    # the same per food and day, from the rollup rather than the individual entries, for the food statistics
+    parts = [f'''SELECT name, entry_day, entries, protein, carbohydrate, fat, kcals FROM {schema}.food_rollup''']
+    for x in sources:
+        parts.append(f'''SELECT name, entry_day, entries, protein, carbohydrate, fat, kcals FROM {x}''')
+    conn.execute('''DROP VIEW IF EXISTS temp.food_history''')
+    conn.execute(f'''CREATE TEMP VIEW food_history AS {" UNION ALL ".join(parts)}''')
+    conn.commit()
+
+
+class Connection(sqlite3.Connection):
 
+    """sqlite3's connection, subclassed so it can be weakly referenced: the per-connection caches below are
+    dropped with the connection instead of being picked up by the next one that gets the same id()"""
 
-def get_db_connection():
 
-    a = sqlite3.connect("db.sqlite3")
+def get_db_connection(path="db.sqlite3", check_same_thread=True, role=None):
+
+    """open one database file, bringing it up to date first. role is worked out from the tables in the file
+    if it isn't given, see migrations.wanted()"""
+
+    a = sqlite3.connect(path, check_same_thread=check_same_thread, factory=Connection)
     a.row_factory = sqlite3.Row
+    if role is None:
+        role = migrations.detect_role(a)
+    migrations.migrate(a, role)  # bring an older database file up to the current schema
+    _setup_history(a)
+    return a
+
+
+def profile_path(name):
+
+    return os.path.join(PROFILE_DIR, f"{name}.sqlite3")
+
+
+def list_profiles():
+
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    return sorted(x[:-len(".sqlite3")] for x in os.listdir(PROFILE_DIR) if x.endswith(".sqlite3"))
+
+
+def _attach_profile(name, conn):
+
+    path = profile_path(name)
+    if not os.path.exists(path):
+        raise KeyError(f"no profile called {name}")
+    get_db_connection(path, role="profile").close()  # migrate it on its own connection before attaching
+    conn.execute('''ATTACH DATABASE ? AS profile''', (path,))
+    _setup_history(conn)
+
+
+def connect(profile=None, check_same_thread=True):
+
+    """the connection the app uses. Without profiles that's just db.sqlite3. With profiles the shared
+    catalogue is the main database and one person's file is attached to it as "profile", so unqualified
+    table names reach both and switching person is a detach and attach on the same connection.
+    profile defaults to whoever used the app last. Setting the CALORIE_DB environment variable opens that
+    file on its own instead."""
+
+    if DB_PATH or not os.path.exists(CATALOGUE_PATH):
+        return get_db_connection(DB_PATH or "db.sqlite3", check_same_thread)
+    a = get_db_connection(CATALOGUE_PATH, check_same_thread, role="catalogue")
+    if profile is None:
+        row = a.execute('''SELECT value FROM settings WHERE key = ?''', ("current_profile",)).fetchone()
+        profiles = list_profiles()
+        profile = row["value"] if row and row["value"] in profiles else (profiles[0] if profiles else None)
+    if profile is None:
+        raise FileNotFoundError(f"{CATALOGUE_PATH} exists but there are no profiles in {PROFILE_DIR}, "
+                                f"make one with profiles.py")
+    _attach_profile(profile, a)
     return a
 
 
+def current_profile(conn):
+
+    """name of the attached profile, or None without profiles"""
+
+    for row in conn.execute('''PRAGMA database_list'''):
+        if row["name"] == "profile":
+            return os.path.splitext(os.path.basename(row["file"]))[0]
+    return None
+
+
 # first connect to the database then load everything else using this connection as the default arg
-CONN = get_db_connection()
+CONN = connect()
+
+# days since 1970-01-01 of a date string (or 'now') and a modifier like '-1 days', to compare against the
+# indexed entry_day columns
+DAY_NUMBER = "CAST(julianday(date(?, ?)) - 2440587.5 AS INTEGER)"
+
+NUTRIENTS = ["protein", "carbohydrate", "fat", "kcals"]
+
+_UNIT_FACTORS = {}  # ingredient name: {unit: factor}, filled the first time an ingredient is used
+_BATCHES = {}  # id(connection): changes waiting for the batch on that connection to commit
+_LISTENERS = []  # called with the change summary after every write to the consumption and weight tables
+_GOALS = weakref.WeakKeyDictionary()  # connection: (data_version, {nutrient: goal row})
+
+GOAL_MODES = ("at most", "at least", "around")  # a day meets a goal if it's under, over or near the target
+DEFAULT_GOAL_MODES = {"protein": "at least", "carbohydrate": "around", "fat": "around", "kcals": "at most"}
 
 
 def add_ingredient(adict, conn=CONN):
@@ -18,14 +156,32 @@ def add_ingredient(adict, conn=CONN):
     """takes rows from reading the CSV and inserts them into the DB. This function expects dictionaries
     with the same keys as the SQL column names"""
 
-    k = ["protein", "carbohydrate", "fat", "kcals", "unit", "serving_size", "container_name"]
-    v = (adict["name"].lower(),) + tuple(adict[x] for x in k)
-
-    conn.execute('''INSERT INTO ingredients (name,protein,carbohydrate,fat,kcals,unit,serving_size, container_name)
-                    VALUES (?,?,?,?,?,?,?,?)''', v)
+    _insert_ingredient(adict, conn)
     conn.commit()
 
 
+def _insert_ingredient(adict, conn):
+
+    k = ["protein", "carbohydrate", "fat", "kcals", "unit", "serving_size", "container_name", "density"]
+    vals = {x: adict.get(x) for x in k}
+    for x in ["protein", "carbohydrate", "fat", "kcals", "serving_size", "density"]:
+        # values from the CSV or the entry boxes are strings, blank means not given
+        vals[x] = float(vals[x]) if vals[x] not in (None, "") else None
+    for x in ["unit", "container_name"]:
+        vals[x] = vals[x] or None
+    vals["unit_factor"] = units.own_factor(vals["unit"])
+    vals["container_factor"] = units.container_factor(vals["unit"], vals["serving_size"])
+    vals["norm_name"] = migrations.name_key(adict["name"])
+    vals["content_hash"] = migrations.content_key(*(vals[x] for x in NUTRIENTS + ["unit"]))
+    v = (" ".join(adict["name"].lower().split()),) + tuple(vals[x] for x in k + ["unit_factor", "container_factor",
+                                                                               "norm_name", "content_hash"])
+
+    conn.execute('''INSERT INTO ingredients (name,protein,carbohydrate,fat,kcals,unit,serving_size, container_name,
+                    density, unit_factor, container_factor, norm_name, content_hash)
+                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)''', v)
+    _UNIT_FACTORS.pop(v[0], None)
+
+
 def add_recipe(recipe_name, list_of_tups, portions, conn=CONN):
 
     """takes the ingredient list from the main windw, which is a list of tuples of (name, amount, unit). Look
@@ -41,10 +197,10 @@ def add_recipe(recipe_name, list_of_tups, portions, conn=CONN):
     portions = float(portions)
     for tup in list_of_tups:
         info = calc_nutritional_content(tup)
-        pro += float(info["protein"])
-        carb += float(info["carbohydrate"])
-        fat += float(info["fat"])
-        kcal += float(info["kcals"])
+        pro += info["protein"]
+        carb += info["carbohydrate"]
+        fat += info["fat"]
+        kcal += info["kcals"]
 
         name, amt, unit = tup
         comp_string += f"{name}|{amt}|{unit}$"
@@ -56,38 +212,60 @@ def add_recipe(recipe_name, list_of_tups, portions, conn=CONN):
     conn.commit()
 
 
-def calc_nutritional_content(tup):
+def get_unit_factors(name, row=None, conn=CONN):
+
+    """returns the cached {unit: factor} table for an ingredient, building it from the database row
+    the first time the ingredient is asked for"""
+
+    factors = _UNIT_FACTORS.get(name)
+    if factors is None:
+        if row is None:
+            row = get_ingredient(name, conn)
+        factors = units.build_factors(row["unit"], row["serving_size"], row["container_name"], row["density"],
+                                      row["unit_factor"], row["container_factor"])
+        _UNIT_FACTORS[name] = factors
+    return factors
+
+
+def calc_nutritional_content(tup, conn=CONN):
 
     """takes a tuple of (name, amount, unit), looks up the unit, multiplies it by the ingredient
     per-100-unit stats and returns a dictionary with the protein, carbs etc content"""
 
     name, amount, unit = tup
-    # unit might be grams, each, or the container name e.g. can, bottle, we need to check. Get all
-    # info here, also for the purposes of computing the calories and macros
+    # unit might be grams, each, the container name e.g. can, bottle, or anything the unit graph
+    # can convert to the ingredient's own unit
 
-    amount = float(amount)  # TODO: proper type affininty from sqlite
-    row = get_ingredient(name)
+    row = get_ingredient(name, conn)
     if not row:
-        row = get_recipe(name)
+        row = get_recipe(name, conn)
+    if not row:
+        raise KeyError("ingredient or recipe not in db")
+
+    vals = nutrition_from_row(row, name, amount, unit)
+    to_output = tup + vals
+    ks2 = ["name", "amount", "unit"] + NUTRIENTS  # full key list for the output dictionary
+    return {x: y for x, y in zip(ks2, to_output)}  # compile a dictionary
+
+
+def nutrition_from_row(row, name, amount, unit):
 
-    ks = ["protein", "carbohydrate", "fat", "kcals"]
+    """(protein, carbohydrate, fat, kcals) for an amount of an ingredient or recipe row that has already
+    been looked up"""
+
+    amount = float(amount)  # the amount comes from a text entry, stored values are already REAL
     if "unit" not in row.keys():
         # entering a whole meal, nutritional values pre-calculated
-        vals = [row[x] * amount for x in ks]
-    elif unit == row["unit"]:
-        if not unit == "each":
-            amount = amount/100.0  # nutritional info is always per 100 mL/g
-        vals = [row[x]*amount for x in ks]  # compute total value
-    elif unit == row["container_name"]:
-        siz = float(row["serving_size"])/100.0
-        vals = [row[x]*siz*amount for x in ks]
+        factor = 1.0
     else:
-        raise KeyError("unrecognised measurement unit")
+        factors = get_unit_factors(name, row)
+        factor = factors.get(unit)
+        if factor is None:
+            factor = factors.get(units.normalise(unit))
+        if factor is None:
+            raise KeyError("unrecognised measurement unit")
 
-    vals = tuple(vals)
-    to_output = tup + vals
-    ks2 = ["name", "amount", "unit"] + ks  # full key list for the output dictionary
-    return {x: y for x, y in zip(ks2, to_output)}  # compile a dictionary
+    return tuple(row[x] * amount * factor for x in NUTRIENTS)  # compute total value
 
 
 def record_consumption(tup, conn=CONN):
@@ -95,24 +273,48 @@ def record_consumption(tup, conn=CONN):
     """record consumption of a food item. Comes as a tuple of (name, amount, unit). Makes a timestamped entry.
     returns the database row for displaying the info in the UI."""
 
-    nutritional_info = calc_nutritional_content(tup)
+    nutritional_info = calc_nutritional_content(tup, conn)
     ks = ["name", "amount", "unit", "protein", "carbohydrate", "fat", "kcals"]
     vals = [nutritional_info[x] for x in ks]  # make sure the values come in the right order
     vals = tuple(vals)
     to_enter = vals  # concatenate the tuples now we have computed the total nutritional contents
-    conn.execute('''INSERT INTO consumption (name, amount, unit, protein, carbohydrate, fat, kcals)
-                    VALUES (?,?,?,?,?,?,?)''', to_enter)
-    conn.commit()
+    cur = conn.execute('''INSERT INTO consumption (name, amount, unit, protein, carbohydrate, fat, kcals)
+                          VALUES (?,?,?,?,?,?,?)''', to_enter)
+    row = _get_row("consumption", cur.lastrowid, conn)
+    _apply_day_delta(row["entry_day"], _nutrients(row), conn)
+    _journal("insert", "consumption", None, row, conn)
+    _commit(_change("consumption", "insert", None, row), conn)
 
     return nutritional_info
 
 
-def ingest_csv(path):
-
-    with open(path, "r") as f:
-        rd = csv.DictReader(f)
-        for line in rd:
-            add_ingredient(line)
+def ingest_csv(path, conn=CONN):
+
+    """add the ingredients in a CSV file in one transaction. A row is skipped if there's already an
+    ingredient with the same name once case, spacing and punctuation are ignored, so a file that overlaps
+    an earlier import can be imported again. Returns (added, skipped)."""
+
+    known = {row[0] for row in conn.execute('''SELECT norm_name FROM ingredients''')}
+    added = skipped = 0
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('''BEGIN''')
+    try:
+        with open(path, "r") as f:
+            rd = csv.DictReader(f)
+            for line in rd:
+                key = migrations.name_key(line["name"])
+                if key in known:
+                    skipped += 1
+                    continue
+                _insert_ingredient(line, conn)
+                known.add(key)
+                added += 1
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return added, skipped
 
 
 def get_all_ingredient_names(conn=CONN):
@@ -136,6 +338,17 @@ def get_ingredient(name, conn=CONN):
     return a.fetchone()
 
 
+def search_ingredients(partial, limit=50, conn=CONN):
+
+    """ingredient and recipe names containing a piece of text, shortest (closest) matches first"""
+
+    pattern = f"%{partial.lower()}%"
+    a = conn.execute('''SELECT * FROM (SELECT name, 'ingredient' AS kind FROM ingredients WHERE name LIKE ?
+                        UNION ALL SELECT name, 'recipe' AS kind FROM recipes WHERE lower(name) LIKE ?)
+                        ORDER BY length(name), name LIMIT ?''', (pattern, pattern, limit))
+    return [dict(x) for x in a.fetchall()]
+
+
 def get_recipe(name, conn=CONN):
 
     a = conn.execute('''SELECT * from recipes WHERE name = ?''', (name,))
@@ -144,45 +357,38 @@ def get_recipe(name, conn=CONN):
 
 def enter_weight(weight, conn=CONN):
 
-    conn.execute('''INSERT INTO weight (weighin) VALUES (?)''', (weight,))
-    conn.commit()
+    cur = conn.execute('''INSERT INTO weight (weighin) VALUES (?)''', (weight,))
+    row = _get_row("weight", cur.lastrowid, conn)
+    _journal("insert", "weight", None, row, conn)
+    return _commit(_change("weight", "insert", None, row), conn)
 
 
 def get_daily_totals(date=None, date_mod=None, conn=CONN):
 
     """return the last 30 days' totals of protein, carb, fat, kcals, for plotting on the main
     window graph, or a single day's totals if the date argument is specified. Date
-    must be a string like YYYY-MM-DD or 'now' for today's date"""
+    must be a string like YYYY-MM-DD or 'now' for today's date. The totals come from the daily_totals
+    table, which every change to the consumption table keeps up to date."""
 
     if date:
-        if date_mod:
-            a = conn.execute('''select date(entry_time), 
-                                sum(protein), 
-                                sum(carbohydrate), 
-                                sum(fat), 
-                                sum(kcals) 
-                                from consumption 
-                                where date(entry_time) = date(?, ?)''', (date, date_mod))
-        else:
-
-            a = conn.execute('''select date(entry_time), 
-                                sum(protein), 
-                                sum(carbohydrate), 
-                                sum(fat), 
-                                sum(kcals) 
-                                from consumption 
-                                where date(entry_time) = date(?)''', (date,))
+        a = conn.execute(f'''select date(entry_day + 2440587.5) as "date(entry_time)", 
+                             protein as "sum(protein)", 
+                             carbohydrate as "sum(carbohydrate)", 
+                             fat as "sum(fat)", 
+                             kcals as "sum(kcals)" 
+                             from daily_totals 
+                             where entry_day = {DAY_NUMBER}''', (date, date_mod or "+0 days"))
     else:
-        a = conn.execute('''select date(entry_time), 
-                            sum(protein), 
-                            sum(carbohydrate), 
-                            sum(fat), 
-                            sum(kcals) 
-                            from consumption 
-                            group by date(entry_time)''')
+        a = conn.execute('''select date(entry_day + 2440587.5) as "date(entry_time)", 
+                            protein as "sum(protein)", 
+                            carbohydrate as "sum(carbohydrate)", 
+                            fat as "sum(fat)", 
+                            kcals as "sum(kcals)" 
+                            from daily_totals 
+                            order by entry_day''')
 
     ret = a.fetchall()
-    if ret[0]["sum(kcals)"]:
+    if ret and ret[0]["sum(kcals)"]:
         # check that the row actually contains values, if not, the user is asking for a date with no entry
         # and instead we will return zero values (below)
         return ret
@@ -201,13 +407,13 @@ def get_daily_weighins(conn=CONN):
 
     """return the last 30 day's worth of weight measurements."""
 
-    a = conn.execute('''select date(entry_time), weighin from weight''')
+    a = conn.execute('''select id, date(entry_time), weighin from weight order by entry_day, id''')
     return a.fetchall()
 
 
 def get_today_weight(conn=CONN):
 
-    a = conn.execute('''SELECT weighin FROM weight WHERE date(entry_time) = date("now")''')
+    a = conn.execute(f'''SELECT weighin FROM weight WHERE entry_day = {DAY_NUMBER}''', ("now", "+0 days"))
     return a.fetchone()
 
 
@@ -217,15 +423,606 @@ def get_day_consumption(date, conn=CONN):
     to plot where the day's calories came from. Do some processing to condense down into a maximum of 6 entries
     with a generic 'other' category for small items consumed."""
 
-    a = conn.execute('''SELECT name, kcals FROM consumption WHERE date(entry_time) = ? ORDER BY kcals DESC''',
-                     (date,))
+    a = conn.execute(f'''SELECT name, kcals FROM consumption_history WHERE entry_day = {DAY_NUMBER}
+                         ORDER BY kcals DESC''', (date, "+0 days"))
+    return condense_calorie_split(a.fetchall())
+
+
+def condense_calorie_split(rows):
+
+    """rows must be sorted by kcals, biggest first"""
+
     out = {}
     other = 0
-    for cnt, row in enumerate(a.fetchall()):
+    for cnt, row in enumerate(rows):
         if cnt < 6:
-            out[row["name"]] = row["kcals"]
+            out[row["name"]] = out.get(row["name"], 0) + row["kcals"]  # the same food can be eaten twice
         else:
             # compile the smaller items into a generic "other" category if there are too many
             other += row["kcals"]
     out["other"] = other
-    return out
\ No newline at end of file
+    return out
+
+
+LOG_TABLES = ("consumption", "weight")  # the tables that can be edited and have their changes undone
+
+
+def today(conn=CONN):
+
+    """today's date as YYYY-MM-DD in the same (UTC) calendar as CURRENT_TIMESTAMP"""
+
+    return conn.execute('''SELECT date('now')''').fetchone()[0]
+
+
+def add_listener(callback):
+
+    """callback is given the change summary (see _change) after each committed write"""
+
+    _LISTENERS.append(callback)
+
+
+def _notify(change):
+
+    for callback in _LISTENERS:
+        callback(change)
+    return change
+
+
+def _commit(change, conn=CONN):
+
+    """commit a write and tell the listeners about it, or hold both back until the end of the batch if
+    the connection is inside batch()"""
+
+    if id(conn) in _BATCHES:
+        _BATCHES[id(conn)].append(change)
+        return change
+    conn.commit()
+    return _notify(change)
+
+
+@contextlib.contextmanager
+def batch(conn=CONN):
+
+    """run several of the write functions as a single transaction, e.g.
+
+        with db.batch(conn):
+            db.record_consumption(("egg", 2, "each"), conn)
+            db.enter_weight(70.1, conn)
+
+    the listeners hear about the changes only once everything has been committed"""
+
+    if conn.in_transaction:
+        conn.commit()
+    _BATCHES[id(conn)] = []
+    conn.execute('''BEGIN''')
+    try:
+        yield
+    except Exception:
+        conn.rollback()
+        del _BATCHES[id(conn)]
+        raise
+    conn.commit()
+    for change in _BATCHES.pop(id(conn)):
+        _notify(change)
+
+
+def day_to_date(day):
+
+    """converts an entry_day number back into a YYYY-MM-DD string"""
+
+    return (datetime.date(1970, 1, 1) + datetime.timedelta(days=day)).isoformat()
+
+
+def _nutrients(row, sign=1):
+
+    return {k: sign * (row[k] or 0.0) for k in NUTRIENTS}
+
+
+def _get_row(table, row_id, conn=CONN):
+
+    if table not in LOG_TABLES:
+        raise KeyError(f"no editable table called {table}")
+    return conn.execute(f'''SELECT * FROM {table} WHERE id = ?''', (row_id,)).fetchone()
+
+
+def _apply_day_delta(day, delta, conn=CONN):
+
+    """add a signed amount of each nutrient to one day's totals, removing the day again if it no
+    longer has any consumption entries"""
+
+    conn.execute('''INSERT INTO daily_totals (entry_day, protein, carbohydrate, fat, kcals) VALUES (?,?,?,?,?)
+                    ON CONFLICT(entry_day) DO UPDATE SET protein = protein + excluded.protein,
+                    carbohydrate = carbohydrate + excluded.carbohydrate,
+                    fat = fat + excluded.fat,
+                    kcals = kcals + excluded.kcals''', (day,) + tuple(delta[k] for k in NUTRIENTS))
+    conn.execute('''DELETE FROM daily_totals WHERE entry_day = ?
+                    AND NOT EXISTS (SELECT 1 FROM consumption_history WHERE entry_day = ?)''', (day, day))
+    _update_goal_day(day, conn)
+
+
+def _journal(op, table, before, after, conn=CONN):
+
+    """record a change to one row so that undo() can reverse it, rows are stored as JSON"""
+
+    row_id = (after or before)["id"]
+    enc = [json.dumps(dict(x)) if x is not None else None for x in (before, after)]
+    conn.execute('''INSERT INTO journal (op, tbl, row_id, before, after) VALUES (?,?,?,?,?)''',
+                 (op, table, row_id, *enc))
+
+
+def _change(table, op, before, after):
+
+    """summary of a change for the UI: which day it touched and by how much, so the running totals and the
+    graphs can be adjusted without going back to the database"""
+
+    row = after if after is not None else before
+    out = {"table": table, "op": op, "id": row["id"], "date": day_to_date(row["entry_day"]),
+           "before": dict(before) if before is not None else None,
+           "after": dict(after) if after is not None else None}
+    if table == "consumption":
+        delta = {k: 0.0 for k in NUTRIENTS}
+        for r, sign in ((before, -1), (after, 1)):
+            if r is not None:
+                for k, v in _nutrients(r, sign).items():
+                    delta[k] += v
+        out["delta"] = delta
+    else:
+        out["weighin"] = after["weighin"] if after is not None else None
+    return out
+
+
+def get_day_entries(date, conn=CONN):
+
+    """every consumption and weight row for one day, with their ids, for the editing panel"""
+
+    food = conn.execute(f'''SELECT * FROM consumption WHERE entry_day = {DAY_NUMBER} ORDER BY entry_time''',
+                        (date, "+0 days")).fetchall()
+    weights = conn.execute(f'''SELECT * FROM weight WHERE entry_day = {DAY_NUMBER} ORDER BY entry_time''',
+                           (date, "+0 days")).fetchall()
+    return food, weights
+
+
+def update_consumption(row_id, tup, conn=CONN):
+
+    """replace an existing consumption entry with a new (name, amount, unit), keeping its timestamp"""
+
+    before = _get_row("consumption", row_id, conn)
+    info = calc_nutritional_content(tup, conn)
+    conn.execute('''UPDATE consumption SET name = ?, amount = ?, unit = ?, protein = ?, carbohydrate = ?, fat = ?,
+                    kcals = ? WHERE id = ?''',
+                 tuple(info[x] for x in ["name", "amount", "unit"] + NUTRIENTS) + (row_id,))
+    after = _get_row("consumption", row_id, conn)
+    change = _change("consumption", "update", before, after)
+    _apply_day_delta(after["entry_day"], change["delta"], conn)
+    _journal("update", "consumption", before, after, conn)
+    return _commit(change, conn)
+
+
+def delete_consumption(row_id, conn=CONN):
+
+    before = _get_row("consumption", row_id, conn)
+    conn.execute('''DELETE FROM consumption WHERE id = ?''', (row_id,))
+    _apply_day_delta(before["entry_day"], _nutrients(before, -1), conn)
+    _journal("delete", "consumption", before, None, conn)
+    return _commit(_change("consumption", "delete", before, None), conn)
+
+
+def update_weight(row_id, weight, conn=CONN):
+
+    before = _get_row("weight", row_id, conn)
+    conn.execute('''UPDATE weight SET weighin = ? WHERE id = ?''', (weight, row_id))
+    after = _get_row("weight", row_id, conn)
+    _journal("update", "weight", before, after, conn)
+    return _commit(_change("weight", "update", before, after), conn)
+
+
+def delete_weight(row_id, conn=CONN):
+
+    before = _get_row("weight", row_id, conn)
+    conn.execute('''DELETE FROM weight WHERE id = ?''', (row_id,))
+    _journal("delete", "weight", before, None, conn)
+    return _commit(_change("weight", "delete", before, None), conn)
+
+
+def undo(conn=CONN):
+
+    """reverse the most recent change in the journal and remove it from the journal, so calling this
+    repeatedly steps further back. Returns the change that was made to reverse it, or None if there is
+    nothing left to undo."""
+
+    j = conn.execute('''SELECT * FROM journal ORDER BY id DESC LIMIT 1''').fetchone()
+    if not j:
+        return None
+    table = j["tbl"]
+    before = json.loads(j["before"]) if j["before"] else None
+    after = json.loads(j["after"]) if j["after"] else None
+    current = _get_row(table, j["row_id"], conn)
+
+    if before is None:
+        # undoing an insert
+        conn.execute(f'''DELETE FROM {table} WHERE id = ?''', (j["row_id"],))
+        restored = None
+    else:
+        # undoing an update or a delete, put the old values back under the same id
+        cols = [k for k in before.keys() if k != "entry_day"]  # entry_day is generated from entry_time
+        if current is None:
+            conn.execute(f'''INSERT INTO {table} ({", ".join(cols)}) VALUES ({", ".join("?" * len(cols))})''',
+                         tuple(before[k] for k in cols))
+        else:
+            # not INSERT OR REPLACE, which takes the current row out without running the delete triggers
+            conn.execute(f'''UPDATE {table} SET {", ".join(f"{k} = ?" for k in cols)} WHERE id = ?''',
+                         tuple(before[k] for k in cols) + (j["row_id"],))
+        restored = _get_row(table, j["row_id"], conn)
+
+    conn.execute('''DELETE FROM journal WHERE id = ?''', (j["id"],))
+    if current is None and restored is None:
+        # the row has already gone, nothing on screen needs to change
+        conn.commit()
+        return None
+
+    change = _change(table, "undo", current, restored)
+    if table == "consumption":
+        if current is not None:
+            _apply_day_delta(current["entry_day"], _nutrients(current, -1), conn)
+        if restored is not None:
+            _apply_day_delta(restored["entry_day"], _nutrients(restored), conn)
+    return _commit(change, conn)
+
+
+def rebuild_daily_totals(days=None, conn=CONN):
+
+    """work out daily_totals again from scratch, for after bulk changes that didn't keep it up to date,
+    either for every day or only for a list of entry_day numbers. Runs in the caller's transaction if
+    there is one."""
+
+    if days is None:
+        where, args = "entry_day IS NOT NULL", ()
+    else:
+        days = list(days)
+        where, args = f"entry_day IN ({', '.join('?' * len(days))})", tuple(days)
+    conn.execute(f'''DELETE FROM daily_totals WHERE {where}''', args)
+    conn.execute(f'''INSERT INTO daily_totals (entry_day, protein, carbohydrate, fat, kcals)
+                     SELECT entry_day, total(protein), total(carbohydrate), total(fat), total(kcals)
+                     FROM consumption_history WHERE {where} GROUP BY entry_day''', args)
+    if days is None:
+        for nutrient in _goals(conn):
+            _rebuild_goal(nutrient, conn)
+    else:
+        for day in sorted(days):
+            _update_goal_day(day, conn)
+
+
+def _goals(conn):
+
+    """the goal rows, read again whenever another connection (the server, say) has committed to the file"""
+
+    version = conn.execute(f'''PRAGMA {log_schema(conn)}.data_version''').fetchone()[0]
+    cached = _GOALS.get(conn)
+    if cached is None or cached[0] != version:
+        cached = (version, {row["nutrient"]: dict(row) for row in conn.execute('''SELECT * FROM goals''')})
+        _GOALS[conn] = cached
+    return cached[1]
+
+
+def goal_met(goal, value):
+
+    """whether a day's total of a nutrient meets a goal row, within its tolerance (a fraction of the target)"""
+
+    slack = goal["tolerance"] * goal["target"]
+    if goal["mode"] == "at most":
+        return value <= goal["target"] + slack
+    if goal["mode"] == "at least":
+        return value >= goal["target"] - slack
+    return abs(value - goal["target"]) <= slack
+
+
+def _update_goal_day(day, conn=CONN):
+
+    """bring one day's goal_days rows and the goal_stats counts into line with its daily_totals row. Only
+    that day is looked at, plus the streak lengths of the days after it if whether it met the goal changed,
+    which for an entry made today is none."""
+
+    goals = _goals(conn)
+    if not goals:
+        return
+    row = conn.execute('''SELECT * FROM daily_totals WHERE entry_day = ?''', (day,)).fetchone()
+    for nutrient, goal in goals.items():
+        if day < goal["since"]:
+            continue
+        old = conn.execute('''SELECT value, met, run FROM goal_days WHERE nutrient = ? AND entry_day = ?''',
+                           (nutrient, day)).fetchone()
+        if row is None:
+            # no entries left that day, so it no longer counts and breaks any streak across it
+            if old is None:
+                continue
+            conn.execute('''DELETE FROM goal_days WHERE nutrient = ? AND entry_day = ?''', (nutrient, day))
+            conn.execute('''UPDATE goal_stats SET days = days - 1, met = met - ?, total = total - ?
+                            WHERE nutrient = ?''', (old["met"], old["value"], nutrient))
+        else:
+            value = row[nutrient]
+            met = int(goal_met(goal, value))
+            conn.execute('''INSERT INTO goal_days (nutrient, entry_day, value, met) VALUES (?,?,?,?)
+                            ON CONFLICT (nutrient, entry_day) DO UPDATE SET value = excluded.value,
+                            met = excluded.met''', (nutrient, day, value, met))
+            conn.execute('''UPDATE goal_stats SET days = days + ?, met = met + ?, total = total + ?
+                            WHERE nutrient = ?''',
+                         (0 if old else 1, met - (old["met"] if old else 0), value - (old["value"] if old else 0),
+                          nutrient))
+            if old is not None and old["met"] == met:
+                continue  # the streaks haven't changed
+        _goal_runs(nutrient, day, old["run"] if row is None else 0, conn)
+
+
+def _goal_runs(nutrient, day, dropped=0, conn=CONN):
+
+    """work the streak lengths out again from day onwards, stopping as soon as one comes out the same as
+    before since every later one only depends on the one before it. dropped is the streak length of a day
+    that was just taken out."""
+
+    prev = conn.execute('''SELECT run FROM goal_days WHERE nutrient = ? AND entry_day = ?''',
+                        (nutrient, day - 1)).fetchone()
+    run = prev["run"] if prev else 0
+    last = day - 1
+    best = conn.execute('''SELECT best_run FROM goal_stats WHERE nutrient = ?''', (nutrient,)).fetchone()[0]
+    lost_best = dropped > 0 and dropped == best
+    done = False
+    while not done:
+        rows = conn.execute('''SELECT entry_day, met, run FROM goal_days WHERE nutrient = ? AND entry_day >= ?
+                               ORDER BY entry_day LIMIT 64''', (nutrient, last + 1 if last >= day else day)).fetchall()
+        done = len(rows) < 64
+        for r in rows:
+            run = (run + 1 if r["entry_day"] == last + 1 else 1) if r["met"] else 0
+            last = r["entry_day"]
+            if r["entry_day"] > day and run == r["run"]:
+                done = True
+                break
+            if r["run"] == best and run < best:
+                lost_best = True
+            best = max(best, run)
+            conn.execute('''UPDATE goal_days SET run = ? WHERE nutrient = ? AND entry_day = ?''',
+                         (run, nutrient, r["entry_day"]))
+    if lost_best:
+        # the longest streak was just broken up, rare enough to look for the new longest
+        best = conn.execute('''SELECT coalesce(max(run), 0) FROM goal_days WHERE nutrient = ?''',
+                            (nutrient,)).fetchone()[0]
+    conn.execute('''UPDATE goal_stats SET best_run = ? WHERE nutrient = ?''', (best, nutrient))
+
+
+def _rebuild_goal(nutrient, conn=CONN):
+
+    """work out every day of a goal from daily_totals, for a new or changed goal or after a bulk import"""
+
+    goal = _goals(conn)[nutrient]
+    conn.execute('''DELETE FROM goal_days WHERE nutrient = ?''', (nutrient,))
+    rows = []
+    run, last = 0, None
+    for day, value in conn.execute(f'''SELECT entry_day, {nutrient} FROM daily_totals WHERE entry_day >= ?
+                                      ORDER BY entry_day''', (goal["since"],)).fetchall():
+        met = int(goal_met(goal, value))
+        run = (run + 1 if last == day - 1 else 1) if met else 0
+        last = day
+        rows.append((nutrient, day, value, met, run))
+    conn.executemany('''INSERT INTO goal_days (nutrient, entry_day, value, met, run) VALUES (?,?,?,?,?)''', rows)
+    conn.execute('''INSERT OR REPLACE INTO goal_stats (nutrient, days, met, total, best_run) VALUES (?,?,?,?,?)''',
+                 (nutrient, len(rows), sum(r[3] for r in rows), sum(r[2] for r in rows),
+                  max((r[4] for r in rows), default=0)))
+
+
+def get_goals(conn=CONN):
+
+    return dict(_goals(conn))
+
+
+def set_goal(nutrient, target, mode=None, tolerance=0.1, since="now", conn=CONN):
+
+    """set the daily target for a nutrient, counting days from since (a date, or 'now'), and work out the
+    days since then"""
+
+    if nutrient not in NUTRIENTS:
+        raise KeyError(f"no nutrient called {nutrient}")
+    mode = mode or DEFAULT_GOAL_MODES[nutrient]
+    if mode not in GOAL_MODES:
+        raise ValueError(f"goal mode must be one of {', '.join(GOAL_MODES)}")
+    conn.execute(f'''INSERT OR REPLACE INTO goals (nutrient, target, mode, tolerance, since)
+                     VALUES (?, ?, ?, ?, {DAY_NUMBER})''',
+                 (nutrient, float(target), mode, float(tolerance), since, "+0 days"))
+    _GOALS.pop(conn, None)
+    _rebuild_goal(nutrient, conn)
+    conn.commit()
+
+
+def clear_goal(nutrient, conn=CONN):
+
+    for table in ("goals", "goal_days", "goal_stats"):
+        conn.execute(f'''DELETE FROM {table} WHERE nutrient = ?''', (nutrient,))
+    _GOALS.pop(conn, None)
+    conn.commit()
+
+
+def goal_progress(date="now", conn=CONN):
+
+    """how a day is going against each goal: {nutrient: dict} with the target and the day's total, the
+    target for the day once whatever was under or over budget earlier in the week (Monday to Sunday) is
+    spread over the rest of it, the current streak, and the long-run counts from goal_stats. Only reads the
+    day, the day before, the week so far and one summary row per goal."""
+
+    day = conn.execute(f'''SELECT {DAY_NUMBER}''', (date, "+0 days")).fetchone()[0]
+    week_start = day - (day + 3) % 7  # day 0, 1970-01-01, was a Thursday
+    out = {}
+    for nutrient, goal in _goals(conn).items():
+        runs = {r["entry_day"]: r for r in conn.execute('''SELECT entry_day, value, met, run FROM goal_days
+                                                         WHERE nutrient = ? AND entry_day IN (?, ?)''',
+                                                      (nutrient, day - 1, day))}
+        today = runs.get(day)
+        yesterday = runs.get(day - 1)
+        if today is not None and today["met"]:
+            streak = today["run"]
+        else:
+            streak = yesterday["run"] if yesterday is not None else 0
+        used = conn.execute(f'''SELECT total({nutrient}) FROM daily_totals
+                               WHERE entry_day >= ? AND entry_day < ?''', (week_start, day)).fetchone()[0]
+        budget = goal["target"] * 7
+        stats = conn.execute('''SELECT * FROM goal_stats WHERE nutrient = ?''', (nutrient,)).fetchone()
+        out[nutrient] = {"target": goal["target"], "mode": goal["mode"],
+                         "value": today["value"] if today is not None else 0.0,
+                         "met": bool(today["met"]) if today is not None else False,
+                         "day_target": (budget - used) / (7 - (day - week_start)),
+                         "week_used": used, "week_budget": budget,
+                         "streak": streak, "best_streak": stats["best_run"],
+                         "days": stats["days"], "met_days": stats["met"],
+                         "surplus": stats["total"] - stats["days"] * goal["target"]}
+    return out
+
+
+def _day_range(start, end, conn):
+
+    """entry_day numbers for dates from start to end inclusive, either of them None for no limit"""
+
+    lo = conn.execute(f'''SELECT {DAY_NUMBER}''', (start, "+0 days")).fetchone()[0] if start else -2 ** 31
+    hi = conn.execute(f'''SELECT {DAY_NUMBER}''', (end, "+0 days")).fetchone()[0] if end else 2 ** 31
+    return lo, hi
+
+
+def top_foods(by="kcals", n=20, start=None, end=None, conn=CONN):
+
+    """the n foods with the most of a nutrient, or the most entries if by is "entries", between two dates
+    (YYYY-MM-DD, inclusive, None for no limit). Returns dicts of the name, the number of days it was eaten
+    and its entries and nutrient totals, biggest first. Reads the per-food daily sums, not the entries."""
+
+    if by not in ["entries"] + NUTRIENTS:
+        raise ValueError(f"can't rank foods by {by}")
+    lo, hi = _day_range(start, end, conn)
+    a = conn.execute(f'''SELECT name, count(DISTINCT entry_day) AS days, total(entries) AS entries,
+                          total(protein) AS protein, total(carbohydrate) AS carbohydrate, total(fat) AS fat,
+                          total(kcals) AS kcals FROM food_history WHERE entry_day BETWEEN ? AND ?
+                          GROUP BY name ORDER BY {by} DESC LIMIT ?''', (lo, hi, n))
+    return [dict(x) for x in a.fetchall()]
+
+
+# SQL for the date a day falls in for each size of step in food_series, weeks start on Monday
+_BUCKETS = {"day": "date(entry_day * 86400, 'unixepoch')",
+            "week": "date((entry_day - (entry_day + 3) % 7) * 86400, 'unixepoch')",
+            "month": "date(entry_day * 86400, 'unixepoch', 'start of month')"}
+
+
+def food_series(name, start=None, end=None, bucket="day", conn=CONN):
+
+    """one food's entries and nutrient totals per day, week or month between two dates, oldest first, as
+    dicts with the date of the day or the first day of the week or month. Steps it wasn't eaten in are
+    left out."""
+
+    lo, hi = _day_range(start, end, conn)
+    a = conn.execute(f'''SELECT {_BUCKETS[bucket]} AS date, total(entries) AS entries, total(protein) AS protein,
+                          total(carbohydrate) AS carbohydrate, total(fat) AS fat, total(kcals) AS kcals
+                          FROM food_history WHERE name = ? AND entry_day BETWEEN ? AND ?
+                          GROUP BY 1 ORDER BY 1''', (name, lo, hi))
+    return [dict(x) for x in a.fetchall()]
+
+
+def food_frequency(name, start=None, end=None, conn=CONN):
+
+    """how often a food was eaten between two dates: entries, days, the first and last day, and days
+    eaten per week over the range, which runs from the first time it was eaten if start is None and up to
+    today if end is None"""
+
+    lo, hi = _day_range(start, end, conn)
+    row = conn.execute('''SELECT total(entries) AS entries, count(DISTINCT entry_day) AS days,
+                           min(entry_day) AS first, max(entry_day) AS last
+                           FROM food_history WHERE name = ? AND entry_day BETWEEN ? AND ?''', (name, lo, hi)).fetchone()
+    if not row["days"]:
+        return {"entries": 0, "days": 0, "first": None, "last": None, "per_week": 0.0}
+    lo = lo if start else row["first"]
+    hi = hi if end else conn.execute(f'''SELECT {DAY_NUMBER}''', ("now", "+0 days")).fetchone()[0]
+    return {"entries": int(row["entries"]), "days": row["days"], "first": day_to_date(row["first"]),
+            "last": day_to_date(row["last"]), "per_week": row["days"] * 7 / max(hi - lo + 1, 1)}
+
+
+def food_entries(name, start=None, end=None, conn=CONN):
+
+    """the individual entries of one food between two dates, oldest first, read through the (name,
+    entry_time) index. Archived entries only survive as daily sums, see food_series."""
+
+    a = conn.execute('''SELECT * FROM consumption WHERE name = ? AND entry_time >= ?
+                        AND entry_time < coalesce(date(?, '+1 day'), '9999-12-31') ORDER BY entry_time''',
+                     (name, start or "", end))
+    return a.fetchall()
+
+
+def archive_consumption(horizon_days, archive_path=None, conn=CONN):
+
+    """move consumption rows older than horizon_days into the per-day, per-food summary table, either in
+    this database or in a separate archive file which is then attached every time the database is opened.
+    The daily totals are untouched and get_day_consumption reads both, so nothing disappears from the
+    graphs. Returns the number of rows that were archived."""
+
+    if conn.in_transaction:
+        conn.commit()
+    log = log_schema(conn)
+    schema = log
+    if archive_path:
+        archive_path = os.path.abspath(archive_path)
+        current = conn.execute(f'''SELECT value FROM {log}.settings WHERE key = ?''', ("archive_path",)).fetchone()
+        if current and current["value"] != archive_path:
+            raise ValueError(f"this database is already archived to {current['value']}")
+        conn.execute(f'''INSERT OR REPLACE INTO {log}.settings (key, value) VALUES (?, ?)''',
+                     ("archive_path", archive_path))
+        conn.commit()
+        if not current:
+            _setup_history(conn)  # attaches the new file
+        schema = "archive"
+
+    cutoff = conn.execute(f'''SELECT {DAY_NUMBER}''', ("now", f"-{int(horizon_days)} days")).fetchone()[0]
+    conn.execute('''BEGIN''')
+    try:
+        conn.execute(f'''INSERT INTO {schema}.consumption_archive
+                         (entry_day, name, unit, amount, protein, carbohydrate, fat, kcals, entries)
+                         SELECT entry_day, name, coalesce(unit, ''), total(amount), total(protein), total(carbohydrate),
+                         total(fat), total(kcals), count(*) FROM {log}.consumption
+                         WHERE entry_day < ? GROUP BY entry_day, name, coalesce(unit, '')
+                         ON CONFLICT (entry_day, name, unit) DO UPDATE SET amount = amount + excluded.amount,
+                         protein = protein + excluded.protein,
+                         carbohydrate = carbohydrate + excluded.carbohydrate,
+                         fat = fat + excluded.fat,
+                         kcals = kcals + excluded.kcals,
+                         entries = entries + excluded.entries''', (cutoff,))
+        conn.execute(f'''INSERT OR IGNORE INTO {log}.archived_uuids (uuid)
+                         SELECT uuid FROM {log}.consumption WHERE entry_day < ? AND uuid IS NOT NULL''', (cutoff,))
+        last_seq = conn.execute(f'''SELECT coalesce(max(seq), 0) FROM {log}.changelog''').fetchone()[0]
+        moved = conn.execute(f'''DELETE FROM {log}.consumption WHERE entry_day < ?''', (cutoff,)).rowcount
+        # archiving is local housekeeping, other synced copies keep their own entries. Their later changes to
+        # these rows are turned away by sync using archived_uuids, see sync._apply_one
+        conn.execute(f'''DELETE FROM {log}.changelog WHERE seq > ?''', (last_seq,))
+        # archived rows can't be edited any more, so their changes can't be undone either
+        conn.execute('''DELETE FROM journal WHERE tbl = 'consumption'
+                        AND json_extract(coalesce(after, before), '$.entry_day') < ?''', (cutoff,))
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+
+    conn.execute(f'''VACUUM {log}''')
+    return moved
+
+
+def switch_profile(name, conn=CONN):
+
+    """detach the current profile and attach another one in its place. The catalogue stays attached as it
+    is, so cached ingredient data is still good, but anything holding the old person's numbers, like
+    DayState, has to be reloaded by the caller. The undo journal is in the profile's file so it follows."""
+
+    if current_profile(conn) is None:
+        raise ValueError("profiles haven't been set up, see profiles.py")
+    if not os.path.exists(profile_path(name)):
+        raise KeyError(f"no profile called {name}")
+    if conn.in_transaction:
+        conn.commit()
+    attached = {row["name"] for row in conn.execute('''PRAGMA database_list''')}
+    conn.execute('''DROP VIEW IF EXISTS temp.consumption_history''')
+    conn.execute('''DROP VIEW IF EXISTS temp.food_history''')
+    if "archive" in attached:
+        conn.execute('''DETACH DATABASE archive''')
+    conn.execute('''DETACH DATABASE profile''')
+    _GOALS.pop(conn, None)  # goals belong to the profile
+    _attach_profile(name, conn)
+    conn.execute('''INSERT OR REPLACE INTO main.settings (key, value) VALUES (?, ?)''', ("current_profile", name))
+    conn.commit()
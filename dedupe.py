@@ -0,0 +1,216 @@
+"""find ingredients that were entered more than once and merge them into one, e.g.
+
+    python dedupe.py                     # list what would be merged
+    python dedupe.py --apply
+    python dedupe.py --similarity 0.9 --apply
+
+Two ingredients are the same food if their names match once case, spacing and punctuation are ignored, or
+if they have the same nutrition and nearly the same name. Both of those are indexed columns on the
+ingredients (see migrations.m007_dedupe_keys), so only ingredients that share a key are ever compared, and
+a large block of them (all the zero-calorie drinks, say) only against the next few names in sorted order
+rather than every pair.
+
+Merging keeps one ingredient of each group and points the recipes, consumption entries, archived history
+and undo journal at it by name, all in one transaction. With profiles the other profiles' history is
+renamed afterwards, one file at a time."""
+
+import argparse
+import difflib
+import re
+import db
+
+
+SIMILARITY = 0.85  # difflib ratio above which two names with the same nutrition are the same food
+WINDOW = 5  # names compared with each other in a block of ingredients with the same nutrition
+
+_NUMBERS = re.compile(r"\d+")
+_DETAIL = ("serving_size", "container_name", "density")  # more of these filled in makes a better survivor
+
+
+class _Groups:
+
+    """union-find over ingredient ids"""
+
+    def __init__(self):
+
+        self.parent = {}
+
+    def find(self, x):
+
+        self.parent.setdefault(x, x)
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def join(self, a, b):
+
+        self.parent[self.find(a)] = self.find(b)
+
+
+def _same_food(a, b, similarity):
+
+    if _NUMBERS.findall(a) != _NUMBERS.findall(b):
+        return False  # "milk 1%" and "milk 2%", or two sizes of a pack
+    if sorted(a.split()) == sorted(b.split()):
+        return True  # the same words in another order
+    m = difflib.SequenceMatcher(None, a, b)
+    return m.real_quick_ratio() >= similarity and m.quick_ratio() >= similarity and m.ratio() >= similarity
+
+
+def find_duplicates(similarity=SIMILARITY, window=WINDOW, conn=db.CONN):
+
+    """groups of ingredient rows that are the same food, each with the one to keep first"""
+
+    groups = _Groups()
+    rows = {}
+
+    last = None
+    for row in conn.execute('''SELECT * FROM ingredients WHERE norm_name IN
+                               (SELECT norm_name FROM ingredients GROUP BY norm_name HAVING count(*) > 1)
+                               ORDER BY norm_name'''):
+        rows[row["id"]] = row
+        if last is not None and last["norm_name"] == row["norm_name"]:
+            groups.join(row["id"], last["id"])
+        last = row
+
+    block = []
+    for row in conn.execute('''SELECT * FROM ingredients WHERE content_hash IN
+                               (SELECT content_hash FROM ingredients WHERE content_hash IS NOT NULL
+                                GROUP BY content_hash HAVING count(*) > 1)
+                               ORDER BY content_hash, norm_name'''):
+        if block and block[-1]["content_hash"] != row["content_hash"]:
+            block = []
+        for other in block[-window:]:
+            if other["norm_name"] == row["norm_name"] or _same_food(other["norm_name"], row["norm_name"],
+                                                                    similarity):
+                rows[row["id"]] = row
+                rows[other["id"]] = other
+                groups.join(row["id"], other["id"])
+        block.append(row)
+
+    out = {}
+    for i, row in rows.items():
+        out.setdefault(groups.find(i), []).append(row)
+    # keep the one with the most detail filled in, then the oldest
+    return [sorted(g, key=lambda r: (-sum(r[k] is not None for k in _DETAIL), r["id"])) for g in out.values()]
+
+
+def _rewrite_composition(comp, renames):
+
+    parts = []
+    for item in comp.split("$"):
+        if item:
+            name, rest = item.split("|", 1)
+            item = f"{renames.get(name, name)}|{rest}"
+        parts.append(item)
+    return "$".join(parts)
+
+
+def _rename_history(conn):
+
+    """point one profile's consumption entries, archived summaries and undo journal at the kept names,
+    inside the caller's transaction, from the old and new names in temp.renames"""
+
+    log = db.log_schema(conn)
+    conn.execute(f'''UPDATE {log}.consumption SET name = (SELECT new FROM temp.renames WHERE old = name)
+                     WHERE name IN (SELECT old FROM temp.renames)''')
+    attached = {row["name"] for row in conn.execute('''PRAGMA database_list''')}
+    for schema in (log, "archive"):
+        if schema not in attached:
+            continue
+        # a day can already have a row for the kept name, so the renamed rows are added onto it
+        conn.execute(f'''INSERT INTO {schema}.consumption_archive
+                         (entry_day, name, unit, amount, protein, carbohydrate, fat, kcals, entries)
+                         SELECT entry_day, r.new, unit, total(amount), total(protein), total(carbohydrate),
+                         total(fat), total(kcals), total(entries) FROM {schema}.consumption_archive a
+                         JOIN temp.renames r ON r.old = a.name GROUP BY entry_day, r.new, unit
+                         ON CONFLICT (entry_day, name, unit) DO UPDATE SET amount = amount + excluded.amount,
+                         protein = protein + excluded.protein,
+                         carbohydrate = carbohydrate + excluded.carbohydrate,
+                         fat = fat + excluded.fat,
+                         kcals = kcals + excluded.kcals,
+                         entries = entries + excluded.entries''')
+        conn.execute(f'''DELETE FROM {schema}.consumption_archive WHERE name IN (SELECT old FROM temp.renames)''')
+    for col in ("before", "after"):
+        conn.execute(f'''UPDATE {log}.journal SET {col} = json_set({col}, '$.name',
+                         (SELECT new FROM temp.renames WHERE old = json_extract({col}, '$.name')))
+                         WHERE tbl = 'consumption'
+                         AND json_extract({col}, '$.name') IN (SELECT old FROM temp.renames)''')
+
+
+def _load_renames(renames, conn):
+
+    conn.execute('''CREATE TEMP TABLE IF NOT EXISTS renames (old TEXT PRIMARY KEY, new TEXT NOT NULL)''')
+    conn.execute('''DELETE FROM temp.renames''')
+    conn.executemany('''INSERT INTO temp.renames (old, new) VALUES (?, ?)''', renames.items())
+
+
+def merge(groups, conn=db.CONN):
+
+    """merge each group from find_duplicates() into its first ingredient. Returns {old name: kept name}."""
+
+    renames = {row["name"]: g[0]["name"] for g in groups for row in g[1:]}
+    if not renames:
+        return renames
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('''BEGIN''')
+    try:
+        _load_renames(renames, conn)
+        for row in conn.execute('''SELECT id, composition_string FROM recipes''').fetchall():
+            comp = _rewrite_composition(row["composition_string"] or "", renames)
+            if comp != (row["composition_string"] or ""):
+                conn.execute('''UPDATE recipes SET composition_string = ? WHERE id = ?''', (comp, row["id"]))
+        log = db.log_schema(conn)
+        if conn.execute(f'''SELECT 1 FROM {log}.sqlite_master WHERE name = 'consumption' ''').fetchone():
+            _rename_history(conn)  # not there when the catalogue has been opened on its own
+        conn.execute('''DELETE FROM ingredients WHERE name IN (SELECT old FROM temp.renames)''')
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    for name in renames:
+        db._UNIT_FACTORS.pop(name, None)
+
+    # a file can't be attached in the middle of a transaction, so the other profiles get their own
+    current = db.current_profile(conn)
+    for name in db.list_profiles() if current is not None else []:
+        if name == current:
+            continue
+        other = db.get_db_connection(db.profile_path(name), role="profile")
+        other.execute('''BEGIN''')
+        try:
+            _load_renames(renames, other)
+            _rename_history(other)
+        except Exception:
+            other.rollback()
+            other.close()
+            raise
+        other.commit()
+        other.close()
+    return renames
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="find and merge ingredients that were entered more than once")
+    parser.add_argument("--apply", action="store_true", help="merge them, otherwise only list them")
+    parser.add_argument("--similarity", type=float, default=SIMILARITY,
+                        help="how alike two names with the same nutrition must be, from 0 to 1")
+    args = parser.parse_args()
+
+    groups = find_duplicates(args.similarity)
+    for g in groups:
+        print(f"{g[0]['name']} <- {', '.join(row['name'] for row in g[1:])}")
+    if not groups:
+        print("no duplicates")
+    elif args.apply:
+        renames = merge(groups)
+        print(f"merged {len(renames)} ingredients into {len(groups)}")
+    else:
+        print(f"{len(groups)} groups, run with --apply to merge them")
+
+
+if __name__ == "__main__":
+    main()
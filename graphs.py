@@ -1,4 +1,5 @@
 from tkinter import *
+import bisect
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import matplotlib.dates as mdates
 from matplotlib.figure import Figure
@@ -50,38 +51,48 @@ class PieChartWidget(Frame):
     def set_title(self, title):
 
         self.ax.set_title(title)
-        self.canvas.draw()
+        self.canvas.draw_idle()
+
+    def redraw(self, data_series, title=None):
 
-    def redraw(self, data_series):
+        """title is set before drawing, so the chart is only rendered once"""
 
         names, data = data_series
         self.fig.clear()
         self.ax = self.fig.add_subplot(111)  # add_subplot returns an axes object
+        if title is not None:
+            self.ax.set_title(title)
+        if not any(data):
+            # nothing eaten that day, matplotlib won't draw a pie with no wedges
+            self.ax.set_axis_off()
+            self.canvas.draw_idle()
+            return
         wedges, text, autopct = self.ax.pie(data, autopct=lambda x: f"{int(x)}% ", textprops={"color": "w"})
         # the autopct lambda function gets passed the percentage as an argument
         self.ax.legend(wedges, names)
-        self.canvas.draw()
+        self.canvas.draw_idle()
 
 
 class DateGraphWidget(Frame):
 
     """line graph that expects a pair of data series: two lists
     of values, one for calories per day, the other for weigh-in per day, to plot kcals and weight
-    on the same chart"""
+    on the same chart. The lists can be empty, e.g. for a new profile, points are added as they come in."""
 
     def __init__(self, *args, xdata=None, caldata=None, xdata2=None, weightdata=None, **kwargs):
 
         super().__init__(*args, **kwargs)
-        if not(xdata and caldata):
+        if xdata is None or caldata is None:
             raise ValueError("must provide x and y data arrays")
-        else:
-            self.xdata = xdata
-            self.xdata2 = xdata2
-            self.caldata = caldata
-            self.weightdata = weightdata
+        self.xdata = xdata
+        self.xdata2 = xdata2 if xdata2 is not None else []
+        self.caldata = caldata
+        self.weightdata = weightdata if weightdata is not None else []
+        xdata2, weightdata = self.xdata2, self.weightdata
 
         self.fig = Figure(figsize=(5, 5), dpi=100)
         self.ax = self.fig.add_subplot(111)
+        self.ax.xaxis_date()  # so dates can be added to empty lines later
         self.ax.set_xlabel("Date")
         self.ax.set_ylabel("weight/kg")
 
@@ -92,6 +103,8 @@ class DateGraphWidget(Frame):
         # pickable data with a tolerance of 5 pixels
         p2, = self.ax2.plot(xdata, caldata, "s-b", picker=5)
         # can only "pick" data from the most recent axis to be plotted
+        self.weight_line = p1
+        self.cal_line = p2  # kept so single points can be changed without replotting everything
 
         self.ax.yaxis.label.set_color(p1.get_color())
         self.ax2.yaxis.label.set_color(p2.get_color())
@@ -120,8 +133,8 @@ class DateGraphWidget(Frame):
         deselects the currently selected data point if there is one."""
 
         # print("on mouse")
-        if not self.picked and len(self.ax2.lines) > 1:
-            self.ax2.lines.pop()  # remove the last Line2D object that we plotted
+        if not self.picked and self.selected is not None:
+            self.selected.remove()  # take the marker off the graph
             self.selected = None
         self.canvas.draw()
         self.picked = False
@@ -134,11 +147,11 @@ class DateGraphWidget(Frame):
         # print("picked")
         # print(e.mouseevent)
         # print(vars(e))
-        if self.selected:
-            self.ax2.lines.pop()  # remove the last Line2D object that we plotted
+        if self.selected is not None:
+            self.selected.remove()  # the marker on the point picked before
             self.selected = None
         if e.mouseevent.button == 1:
-            self.selected = self.ax2.plot([self.xdata[e.ind[0]]], [self.caldata[e.ind[0]]], "go", ms=15)
+            self.selected, = self.ax2.plot([self.xdata[e.ind[0]]], [self.caldata[e.ind[0]]], "go", ms=15)
             # the event has an "index" of the data point, but it's returned as a single value list
             # ms is "marker size" for the plot, "go" is green circles
         self.canvas.draw()  # need to refresh the canvas
@@ -150,39 +163,53 @@ class DateGraphWidget(Frame):
         # this sends the date of the selected point to the root object, so it can plot a pie charts of
         # data from that date
 
-    def redraw(self, xdata, caldata, xdata2, weightdata):
+    def set_kcals(self, date, kcals):
 
-        self.ax.lines.pop()  # remove old weight series
-        while len(self.ax2.lines) > 0:
-            self.ax2.lines.pop()  # might have to pop the picked marker also
+        """change the point for one date, adding the point if the date isn't plotted yet and removing it if
+        the day's total is now nothing"""
 
-        self.ax.plot(xdata2, weightdata, "o-r")
-        self.ax2.plot(xdata, caldata, "s-b", picker=5)
-        self.canvas.draw()
+        _set_series_point(self.xdata, [self.caldata], date, [kcals] if kcals else None)
+        self.cal_line.set_data(self.xdata, self.caldata)
+        self._rescale(self.ax2)
+
+    def set_weight(self, date, weight):
+
+        """change the weigh-in plotted for one date, None removes it"""
+
+        _set_series_point(self.xdata2, [self.weightdata], date, [weight] if weight is not None else None)
+        self.weight_line.set_data(self.xdata2, self.weightdata)
+        self._rescale(self.ax)
+
+    def _rescale(self, ax):
+
+        ax.relim()
+        ax.autoscale_view()
+        self.canvas.draw_idle()
 
 
 class MultiDateGraphWidget(Frame):
 
     """expects one list of date objects and one list of dictionaries, plots each dict
-    key on a separate line"""
+    key on a separate line. keys names the lines, needed if the lists are empty."""
 
-    def __init__(self, *args, xdata=None, ydata=None, **kwargs):
+    def __init__(self, *args, xdata=None, ydata=None, keys=None, **kwargs):
 
         super().__init__(*args, **kwargs)
-        if not(xdata and ydata):
+        if xdata is None or ydata is None or not (keys or ydata):
             raise ValueError("must provide x and y data arrays")
-        else:
-            self.xdata = xdata
-            self.ydata = ydata
+        self.xdata = xdata
+        self.ydata = ydata
 
         self.fig = Figure(figsize=(5, 4), dpi=100)
         self.ax = self.fig.add_subplot(111)
+        self.ax.xaxis_date()  # so dates can be added to empty lines later
         self.ax.set_xlabel("Date")
         self.ax.set_ylabel("macronutrient/grams")
 
         lines = []
 
-        keys = [x for x in ydata[0].keys()]  # get the keys from the first dict and use for all subsequent
+        if keys is None:
+            keys = [x for x in ydata[0].keys()]  # get the keys from the first dict and use for all subsequent
         series = {x: [] for x in keys}
         for i in ydata:
             for j in keys:
@@ -190,6 +217,8 @@ class MultiDateGraphWidget(Frame):
         for x in keys:
             a, = self.ax.plot(xdata, series[x], label=x)  # then plot using the dict we just made
             lines.append(a)  # hold a reference to the lines to build the legend
+        self.series = series
+        self.lines = {x: y for x, y in zip(keys, lines)}
 
         self.ax.legend(lines, [x.get_label() for x in lines])
         self.ax.grid(True)
@@ -202,22 +231,70 @@ class MultiDateGraphWidget(Frame):
 
         self.ax.set_title(title)
 
-    def redraw(self, xdata, ydata):
+    def set_point(self, date, adict):
 
-        self.ax.get_legend().remove()
-        while len(self.ax.lines) > 0:
-            self.ax.lines.pop()
+        """change the values of each line at one date, adding the date if it isn't plotted yet, None or all
+        zeros removes the date"""
 
-        # TODO: remove duplicated code from init method
-        lines = []
-        keys = [x for x in ydata[0].keys()]  # get the keys from the first dict and use for all subsequent
-        series = {x: [] for x in keys}
-        for i in ydata:
-            for j in keys:
-                series[j].append(i[j])  # assemble a dict of {key1: [value1, value2...]}
-        for x, q in zip(keys, ["r-", "g-", "b-"]):
-            a, = self.ax.plot(xdata, series[x], q, label=x)  # then plot using the dict we just made
-            lines.append(a)  # hold a reference to the lines to build the legend
-        self.ax.legend(lines, [x.get_label() for x in lines])
+        keys = list(self.series.keys())
+        if adict is not None and not any(adict[k] for k in keys):
+            adict = None
+        _set_series_point(self.xdata, [self.series[k] for k in keys], date,
+                          [adict[k] for k in keys] if adict is not None else None)
+        for k, line in self.lines.items():
+            line.set_data(self.xdata, self.series[k])
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self.canvas.draw_idle()
 
-        self.canvas.draw()
+
+def _set_series_point(xdata, ylists, x, yvals):
+
+    """set the y values at x in some parallel lists kept sorted by x, inserting x if it's new and removing it
+    if yvals is None"""
+
+    i = bisect.bisect_left(xdata, x)
+    present = i < len(xdata) and xdata[i] == x
+    if yvals is None:
+        if present:
+            del xdata[i]
+            for y in ylists:
+                del y[i]
+    elif present:
+        for y, v in zip(ylists, yvals):
+            y[i] = v
+    else:
+        xdata.insert(i, x)
+        for y, v in zip(ylists, yvals):
+            y.insert(i, v)
+
+
+class BarGraphWidget(Frame):
+
+    """bar chart of values against dates, e.g. one food's kcals per week. The bars are as wide as the step
+    between dates, given in days"""
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+        self.fig = Figure(figsize=(5, 3), dpi=100)
+        self.ax = self.fig.add_subplot(111)
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self)
+        widget = self.canvas.get_tk_widget()
+        widget.pack(side=TOP, fill=BOTH, expand=YES)
+
+    def redraw(self, xdata, ydata, width=1, ylabel=""):
+
+        self.ax.clear()
+        self.ax.bar(xdata, ydata, width=width * 0.8, align="edge")
+        self.ax.set_ylabel(ylabel)
+        self.ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
+        self.ax.grid(True, axis="y")
+        self.fig.autofmt_xdate()
+        self.fig.tight_layout()
+        self.canvas.draw_idle()
+
+    def set_title(self, title):
+
+        self.ax.set_title(title)
+        self.canvas.draw_idle()
@@ -0,0 +1,203 @@
+"""bulk import of consumption history exported from another tracker, keeping the original timestamps, e.g.
+
+    python importer.py history.csv
+    python importer.py history.json --workers 4
+
+Each record needs a food name, an amount, a unit and a timestamp. CSV files need a header row, JSON files
+hold a list of objects. Parsing is spread over worker processes, then everything is inserted in a single
+transaction and the daily totals are worked out once at the end."""
+
+import argparse
+import csv
+import datetime
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import db
+
+
+# accepted spellings of each field in the export
+FIELDS = {
+    "name": ("name", "food", "item", "description"),
+    "amount": ("amount", "quantity", "qty", "serving"),
+    "unit": ("unit", "units", "measure"),
+    "entry_time": ("entry_time", "timestamp", "time", "datetime", "date", "logged_at"),
+}
+
+CHUNK_SIZE = 20000  # records per worker task
+
+
+def _field(record, key):
+
+    for k in FIELDS[key]:
+        if k in record and record[k] not in (None, ""):
+            return record[k]
+    return None
+
+
+def parse_timestamp(val):
+
+    """ISO dates or datetimes, or unix epoch seconds, converted to the UTC 'YYYY-MM-DD HH:MM:SS' that
+    CURRENT_TIMESTAMP produces, so imported rows sort and group the same way as ones entered in the app"""
+
+    if isinstance(val, (int, float)) or str(val).replace(".", "", 1).isdigit():
+        dt = datetime.datetime.fromtimestamp(float(val), datetime.timezone.utc)
+    else:
+        dt = datetime.datetime.fromisoformat(str(val).strip().replace("Z", "+00:00"))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def normalise_records(records):
+
+    """worker function: turns raw records into (name, amount, unit, entry_time) tuples, plus a list of
+    (record, reason) for the ones that can't be read"""
+
+    good = []
+    bad = []
+    for rec in records:
+        try:
+            name = " ".join(str(_field(rec, "name")).lower().split())
+            amount = float(_field(rec, "amount"))
+            unit = _field(rec, "unit")
+            unit = str(unit).strip() if unit is not None else None
+            entry_time = parse_timestamp(_field(rec, "entry_time"))
+        except (TypeError, ValueError) as e:
+            bad.append((rec, str(e)))
+            continue
+        good.append((name, amount, unit, entry_time))
+    return good, bad
+
+
+def _parse_csv_chunk(args):
+
+    header, rows = args
+    return normalise_records(dict(zip(header, row)) for row in rows)
+
+
+def read_chunks(path):
+
+    """split the file into chunks of raw records for the workers. CSV is split into rows here rather than
+    into lines, a quoted field can have a newline in it"""
+
+    if path.lower().endswith(".json"):
+        with open(path, "r") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data = data.get("entries") or data.get("consumption") or []
+        return normalise_records, [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+
+    with open(path, "r", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        rows = [row for row in reader if row]  # blank lines, which DictReader would skip too
+    return _parse_csv_chunk, [(header, rows[i:i + CHUNK_SIZE]) for i in range(0, len(rows), CHUNK_SIZE)]
+
+
+class FoodLookup:
+
+    """every ingredient and recipe read in once, so resolving a name is a dict lookup rather than a query
+    per record"""
+
+    def __init__(self, conn=db.CONN):
+
+        self.rows = {}
+        for row in conn.execute('''SELECT * FROM recipes''').fetchall():
+            self.rows[" ".join(row["name"].lower().split())] = row
+        for row in conn.execute('''SELECT * FROM ingredients''').fetchall():
+            self.rows[" ".join(row["name"].lower().split())] = row  # ingredients win a name clash, as in the app
+
+    def nutrition(self, name, amount, unit):
+
+        """returns (stored name, nutritional values) or raises KeyError"""
+
+        row = self.rows[name]
+        return row["name"], db.nutrition_from_row(row, row["name"], amount, unit)
+
+
+def import_history(path, workers=None, conn=db.CONN):
+
+    """import a CSV or JSON history file. Returns (number of rows inserted, {unresolved name: count},
+    list of unreadable records)"""
+
+    func, chunks = read_chunks(path)
+    records = []
+    unreadable = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for good, bad in pool.map(func, chunks):
+            records.extend(good)
+            unreadable.extend(bad)
+
+    lookup = FoodLookup(conn)
+    rows = []
+    unresolved = {}
+    for name, amount, unit, entry_time in records:
+        try:
+            stored_name, vals = lookup.nutrition(name, amount, unit)
+        except KeyError:
+            # either the food or the unit isn't known
+            key = name if name not in lookup.rows else f"{name} ({unit})"
+            unresolved[key] = unresolved.get(key, 0) + 1
+            continue
+        rows.append((stored_name, amount, unit) + vals + (entry_time,))
+
+    if conn.in_transaction:
+        conn.commit()
+    schema = db.log_schema(conn)
+    indexes = conn.execute(f'''SELECT name, sql FROM {schema}.sqlite_master
+                               WHERE type = 'index' AND tbl_name = 'consumption' AND sql IS NOT NULL''').fetchall()
+    rollup = conn.execute(f'''SELECT name, sql FROM {schema}.sqlite_master
+                              WHERE type = 'trigger' AND name LIKE 'consumption_rollup_%' ''').fetchall()
+    first_id = conn.execute(f'''SELECT coalesce(max(id), 0) FROM {schema}.consumption''').fetchone()[0]
+    conn.execute('''BEGIN''')
+    try:
+        # dropping the indexes and building them again once is much faster than updating them per row, the
+        # same goes for the per-food sums, which are added up for all the new rows at once instead
+        for idx in indexes:
+            conn.execute(f'''DROP INDEX {schema}.{idx["name"]}''')
+        for trigger in rollup:
+            conn.execute(f'''DROP TRIGGER {schema}.{trigger["name"]}''')
+        conn.executemany('''INSERT INTO consumption (name, amount, unit, protein, carbohydrate, fat, kcals, entry_time)
+                            VALUES (?,?,?,?,?,?,?,?)''', rows)
+        for idx in indexes:
+            # the stored sql doesn't name a schema, and an unqualified CREATE INDEX would go in main
+            conn.execute(idx["sql"].replace(f"INDEX {idx['name']}", f"INDEX {schema}.{idx['name']}", 1))
+        for trigger in rollup:
+            conn.execute(trigger["sql"].replace(f"TRIGGER {trigger['name']}", f"TRIGGER {schema}.{trigger['name']}",
+                                                1))
+        conn.execute(f'''INSERT INTO {schema}.food_rollup (name, entry_day, entries, protein, carbohydrate, fat, kcals)
+                         SELECT coalesce(name, ''), entry_day, count(*), total(protein), total(carbohydrate), total(fat),
+                         total(kcals) FROM {schema}.consumption WHERE id > ? GROUP BY coalesce(name, ''), entry_day
+                         ON CONFLICT (name, entry_day) DO UPDATE SET entries = entries + excluded.entries,
+                         protein = protein + excluded.protein,
+                         carbohydrate = carbohydrate + excluded.carbohydrate,
+                         fat = fat + excluded.fat,
+                         kcals = kcals + excluded.kcals''', (first_id,))
+        db.rebuild_daily_totals(conn=conn)
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return len(rows), unresolved, unreadable
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="import consumption history from a CSV or JSON export")
+    parser.add_argument("path")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of parsing processes")
+    args = parser.parse_args()
+
+    inserted, unresolved, unreadable = import_history(args.path, args.workers)
+    print(f"imported {inserted} entries")
+    if unreadable:
+        print(f"{len(unreadable)} records could not be read, e.g. {unreadable[0][0]} ({unreadable[0][1]})")
+    if unresolved:
+        print("not found in the ingredients or recipes:")
+        for name, count in sorted(unresolved.items(), key=lambda x: -x[1]):
+            print(f"    {name}: {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""load test for server.py, run against a server on localhost, e.g.
+
+    python server.py --db copy_of_db.sqlite3 &
+    python loadtest.py --clients 50 --requests 200 --write-ratio 0.2 --food egg --unit each
+
+Writes log real consumption entries, so point the server at a copy of the database if write-ratio is
+above zero."""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+
+async def client(host, port, n, write_ratio, food, unit, latencies, errors):
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(n):
+            r = random.random()
+            if r < write_ratio:
+                body = json.dumps({"name": food, "amount": 1, "unit": unit}).encode()
+                head = f"POST /consumption HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n\r\n"
+            else:
+                body = b""
+                target = "/totals?date=now" if r < (1 + write_ratio) / 2 else f"/ingredients?q={food[:3]}&limit=20"
+                head = f"GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n"
+            start = time.perf_counter()
+            writer.write(head.encode() + body)
+            await writer.drain()
+
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                k, _, v = line.decode().partition(":")
+                if k.lower() == "content-length":
+                    length = int(v)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run(args):
+
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(args.host, args.port, args.requests, args.write_ratio, args.food, args.unit,
+                                  latencies, errors) for _ in range(args.clients)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    total = len(latencies)
+    print(f"{total} requests in {elapsed:.2f} s: {total / elapsed:.0f} requests/s")
+    for p in (50, 90, 99):
+        print(f"    p{p} latency {latencies[min(total - 1, total * p // 100)] * 1000:.1f} ms")
+    if errors:
+        print(f"    {len(errors)} non-200 responses, e.g. {errors[0]}")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="measure requests/sec against a local server.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8321)
+    parser.add_argument("--clients", type=int, default=20, help="concurrent connections")
+    parser.add_argument("--requests", type=int, default=200, help="requests per connection")
+    parser.add_argument("--write-ratio", type=float, default=0.0, help="fraction of requests that log consumption")
+    parser.add_argument("--food", default="egg", help="ingredient to log and search for")
+    parser.add_argument("--unit", default="each")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,8 @@ from tkinter import *
 import db
 import re
 from graphs import *
+from daystate import DayState
+import planner
 import datetime
 
 
@@ -34,6 +36,10 @@ class App(Frame, LoggingMixIn):
         self.graph_window = GraphWindow(self)
         self.graph_window.pack(side=LEFT, fill=BOTH, expand=YES)
 
+        if db.current_profile(db.CONN) is not None:
+            self.profile_chooser = ProfileChooser(self.cont1)
+            self.profile_chooser.pack(side=TOP, pady=(20, 0))
+
         self.recipe_name_container = Frame(self.cont1)
         self.recipe_name_container.pack(side=TOP, pady=20)
         self.recipe_name_label = Label(self.recipe_name_container, text="Recipe name")
@@ -56,6 +62,9 @@ class App(Frame, LoggingMixIn):
         self.entry_boxes = MyEntryBoxes(self.cont1)
         self.entry_boxes.pack(side=TOP)
 
+        self.plan_panel = PlanPanel(self.cont1)
+        self.plan_panel.pack(side=TOP, fill=BOTH, expand=YES)
+
         self.console = LoggingConsole(self.cont1, height=20, width=30)
         # this receives messages from the root object
         self.console.pack(side=TOP, fill=BOTH, expand=YES)
@@ -63,6 +72,15 @@ class App(Frame, LoggingMixIn):
         self.running_totals = RunningTotals(self.cont2, borderwidth=5, relief=RIDGE)
         self.running_totals.pack(side=TOP, fill=BOTH, expand=Y)
 
+        self.goals_panel = GoalsPanel(self.cont2, borderwidth=5, relief=RIDGE)
+        self.goals_panel.pack(side=TOP, fill=BOTH, expand=Y)
+
+        self.meal_planner = MealPlanner(self.cont2, borderwidth=5, relief=RIDGE)
+        self.meal_planner.pack(side=TOP, fill=BOTH, expand=Y)
+
+        self.entry_editor = EntryEditor(self.cont2, borderwidth=5, relief=RIDGE)
+        self.entry_editor.pack(side=TOP, fill=BOTH, expand=Y)
+
         self.ingredient_adder = IngredientAdder(self.cont2, borderwidth=5, relief=RIDGE)
         self.ingredient_adder.pack(side=TOP, fill=BOTH, expand=Y)
 
@@ -78,9 +96,8 @@ class App(Frame, LoggingMixIn):
         i, j, k = content
         if self.entry_boxes.checkbox_var.get():
             # "speculative" checkbox is ticked and user just wants to make a plan, not enter into db
-            nutritional_info = db.calc_nutritional_content(content)
-            self.running_totals.increment_displayed_values(nutritional_info)
-            self.log(f"Added {i}: {j} {k} to speculative running total.")
+            self.plan_panel.add(content)
+            self.log(f"Added {i}: {j} {k} to the plan.")
             self.entry_boxes.clear_all()
             return  # return early to stop the db adding code running
 
@@ -90,11 +107,8 @@ class App(Frame, LoggingMixIn):
             self.log(f"Added {i}: {j} {k} to the recipe for {rname}.")
         else:
             # recording what was eaten today
-            nutritional_info = db.record_consumption(content)
-            self.running_totals.increment_displayed_values(nutritional_info)
+            db.record_consumption(content)  # the day state passes the change on to the totals and graphs
             self.log(f"Consumed {i}: {j} {k}.")
-            self.graph_window.redraw_line_graph()  # update to reflect this consumption
-            self.graph_window.redraw_macro_graph()
         self.entry_boxes.clear_all()
 
     def add_recipe(self):
@@ -112,6 +126,29 @@ class App(Frame, LoggingMixIn):
         self.entry_boxes.refresh_autocompletes()
 
 
+class ProfileChooser(Frame, LoggingMixIn):
+
+    """picks whose consumption and weight are shown and logged, when there are profiles (see profiles.py).
+    The ingredients and recipes are shared so the entry boxes don't need to change."""
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+        lab = Label(self, text="Profile:")
+        lab.pack(side=LEFT)
+        self.current = StringVar(self, db.current_profile(db.CONN))
+        self.menu = OptionMenu(self, self.current, *db.list_profiles(), command=self.switch)
+        self.menu.pack(side=LEFT)
+
+    def switch(self, name):
+
+        db.switch_profile(name)
+        self._root().day_state.reload()
+        self._root().app.goals_panel.load()
+        self._root().app.graph_window.food_history.changed()
+        self.log(f"Switched to {name}'s profile.")
+
+
 class GraphWindow(Frame):
 
     def __init__(self, *args, **kwargs):
@@ -120,31 +157,27 @@ class GraphWindow(Frame):
         self.pie_container = Frame(self)
         self.graph_container = Frame(self)
         self.config(bg="white")
+        self.state = self._root().day_state
 
         self.today_pie = PieChartWidget(self.pie_container)
         self.yesterday_pie = PieChartWidget(self.pie_container)
         # these are overwritten when new pie charts are displayed and are immediately destroyed
 
+        self.pie_date = "now"
         self.show_calorie_split_chart("now")
         self.show_macro_split_chart("now")  # set up pie charts with today's data
 
-        historical_info = db.get_daily_totals()
-        line_graph_data = self.prepare_line_data_series(historical_info)
-
-        weight_info = db.get_daily_weighins()
-        weight_data = self.prepare_line_data_series(weight_info)
-        i, j = weight_data
-
-        a, b = line_graph_data
-        self.line_graph = DateGraphWidget(self.graph_container, xdata=a,
-                                          caldata=[x["sum(kcals)"] for x in b],
-                                          xdata2=i,
-                                          weightdata=[x["weighin"] for x in j])
+        dates = sorted(self.state.totals.keys())
+        weight_dates = sorted(self.state.weights.keys())
+        self.line_graph = DateGraphWidget(self.graph_container, xdata=self.to_datetimes(dates),
+                                          caldata=[self.state.totals[x]["kcals"] for x in dates],
+                                          xdata2=self.to_datetimes(weight_dates),
+                                          weightdata=[self.state.day_weight(x) for x in weight_dates])
         self.line_graph.set_title("Daily kcals/weight")
 
-        macronutrient_info = self.prepare_macronutrient_data_series(historical_info)
-        a, b = macronutrient_info
-        self.macro_graph = MultiDateGraphWidget(self.graph_container, xdata=a, ydata=b)
+        macros = [{k: self.state.totals[x][k] for k in ["protein", "carbohydrate", "fat"]} for x in dates]
+        self.macro_graph = MultiDateGraphWidget(self.graph_container, xdata=self.to_datetimes(dates), ydata=macros,
+                                                keys=["protein", "carbohydrate", "fat"])
         self.macro_graph.set_title("Daily macronutrients")
 
         self.pie_container.pack(side=TOP, fill=BOTH, expand=YES)
@@ -155,37 +188,45 @@ class GraphWindow(Frame):
         self.line_graph.pack(side=LEFT, fill=BOTH, expand=YES, padx=30)
         self.macro_graph.pack(side=LEFT, fill=BOTH, expand=YES)
 
-    def redraw_line_graph(self):
+        self.food_history = FoodHistory(self)
+        self.food_history.pack(side=TOP, fill=BOTH, expand=YES)
 
-        # TODO: refactor so this isn't just copy-pasted code from the init function
-        historical_info = db.get_daily_totals()
-        line_graph_data = self.prepare_line_data_series(historical_info)
-        a, b = line_graph_data
+        self.state.subscribe(self.on_state_change, "totals", "weight", "entries")
 
-        weight_info = db.get_daily_weighins()
-        weight_data = self.prepare_line_data_series(weight_info)
-        i, j = weight_data
+    def to_datetimes(self, dates):
 
-        self.line_graph.redraw(xdata=a,
-                            caldata=[x["sum(kcals)"] for x in b],
-                            xdata2=i,
-                            weightdata=[x["weighin"] for x in j])
+        """the graph needs to be given datetime objects rather than date strings, otherwise it will
+        plot the x-axis as categories rather than a continuous scale"""
 
-    def redraw_macro_graph(self):
+        return [datetime.datetime.strptime(x, "%Y-%m-%d") for x in dates]
 
-        historical_info = db.get_daily_totals()
-        macronutrient_info = self.prepare_macronutrient_data_series(historical_info)
-        a, b = macronutrient_info
-        self.macro_graph.redraw(a, b)
+    def on_state_change(self, changes):
+
+        """move only the points for the days that changed, and redraw a pie chart only if the day it is
+        showing was one of them"""
+
+        for date in changes.get("totals", ()):
+            t = self.state.day_totals(date)
+            dt = self.to_datetimes([date])[0]
+            self.line_graph.set_kcals(dt, t["kcals"])
+            self.macro_graph.set_point(dt, {k: t[k] for k in ["protein", "carbohydrate", "fat"]})
+        for date in changes.get("weight", ()):
+            self.line_graph.set_weight(self.to_datetimes([date])[0], self.state.day_weight(date))
+
+        shown = self.state.normalise_date(self.pie_date)
+        if shown in changes.get("entries", ()):
+            self.show_calorie_split_chart(self.pie_date)
+        if shown in changes.get("totals", ()):
+            self.show_macro_split_chart(self.pie_date)
 
     def prepare_pie_data_series(self, row):
 
-        """converts the sqlite row to a pair of lists suitable for the pie chart widget"""
+        """converts the day's totals to a pair of lists suitable for the pie chart widget"""
 
         names = []
         values = []
-        for k in ["sum(protein)", "sum(carbohydrate)", "sum(fat)"]:
-            names.append(k)
+        for k in ["protein", "carbohydrate", "fat"]:
+            names.append(f"sum({k})")
             values.append(row[k])
         return names, values
 
@@ -202,48 +243,115 @@ class GraphWindow(Frame):
 
     def show_calorie_split_chart(self, date):
 
-        items = db.get_day_consumption(date)
+        self.pie_date = date
+        items = self.state.calorie_split(date)
         dat = self.prepare_calorie_data_series(items)
-        self.today_pie.redraw(dat)
-        self.today_pie.set_title(f"Calorie split for {date}")
+        self.today_pie.redraw(dat, f"Calorie split for {date}")
 
     def show_macro_split_chart(self, date):
 
-        info = db.get_daily_totals(date=date)[0]
+        self.pie_date = date
+        info = self.state.day_totals(date)
         dat = self.prepare_pie_data_series(info)
-        self.yesterday_pie.redraw(dat)
-        self.yesterday_pie.set_title(f"Macronutrient split for {date}")
+        self.yesterday_pie.redraw(dat, f"Macronutrient split for {date}")
 
-    def prepare_line_data_series(self, rowlist):
 
-        """converts the sqlite query for the last 30 days into a pair of lists
-        [date1, date2..], [value1, value2...]"""
+class FoodHistory(Frame, LoggingMixIn):
 
-        dates = []
-        vals = []
-        for x in rowlist:
-            dates.append(datetime.datetime.strptime(x["date(entry_time)"], "%Y-%m-%d"))
-            # the graph needs to be given datetime objects rather than date strings, otherwise it will
-            # plot the x-axis as categories rather than a continuous scale
-            vals.append(x)
-        return dates, vals
+    """the top foods over a period by a nutrient or by how often they were eaten, and a graph of one of
+    them per day, week or month. Everything comes from the per-food daily sums (see db.top_foods), so it
+    doesn't read the individual entries."""
 
-    def prepare_macronutrient_data_series(self, rowlist):
+    RANGES = {"30 days": 30, "90 days": 90, "year": 365, "all time": None}
+    STEP_DAYS = {"day": 1, "week": 7, "month": 30}  # bar widths
 
-        """converts the historical sqlite query into a dict of protein, carbs, fat per day"""
-        # TODO: refactor this as a variant of prepare_line_data, pass desired keys
+    def __init__(self, *args, **kwargs):
 
-        dates = []
-        values = []
-        for x in rowlist:
-            dates.append(datetime.datetime.strptime(x["date(entry_time)"], "%Y-%m-%d"))
-            tmp = {}
-            for k in ["protein", "carbohydrate", "fat"]:
-                v = x[f"sum({k})"]
-                tmp[k] = v
-            values.append(tmp)
+        super().__init__(*args, **kwargs)
+        self.config(bg="white")
+        con = Frame(self)
+        Label(con, text="Food:").pack(side=LEFT)
+        self.name_input = Entry(con, width=25)
+        self.name_input.bind("<Return>", lambda e: self.show_food())
+        self.name_input.pack(side=LEFT)
+        self.by = StringVar(self, "kcals")
+        self.period = StringVar(self, "90 days")
+        self.step = StringVar(self, "week")
+        OptionMenu(con, self.by, *(["entries"] + db.NUTRIENTS), command=self.changed).pack(side=LEFT)
+        OptionMenu(con, self.period, *self.RANGES, command=self.changed).pack(side=LEFT)
+        OptionMenu(con, self.step, *self.STEP_DAYS, command=self.changed).pack(side=LEFT)
+        self.summary = Label(con, text="", anchor=W)
+        self.summary.pack(side=LEFT, padx=10)
+        con.pack(side=TOP, fill=X)
+
+        self.top_list = Listbox(self, exportselection=0, height=10, width=30)
+        self.top_list.bind("<<ListboxSelect>>", self.select)
+        self.top_list.pack(side=LEFT, fill=Y)
+        self.graph = BarGraphWidget(self)
+        self.graph.pack(side=LEFT, fill=BOTH, expand=YES)
+        self.shown = None  # food being graphed
+
+        self.show_top()
+        self._root().day_state.subscribe(self.on_state_change, "foods")
+
+    def start_date(self):
+
+        days = self.RANGES[self.period.get()]
+        if days is None:
+            return None
+        return (datetime.date.fromisoformat(db.today()) - datetime.timedelta(days=days - 1)).isoformat()
+
+    def show_top(self):
+
+        self.top = db.top_foods(self.by.get(), 20, self.start_date())
+        self.top_list.delete(0, END)
+        for row in self.top:
+            self.top_list.insert(END, f"{row['name']}: {round(row[self.by.get()])}")
+
+    def select(self, e):
+
+        index = self.top_list.curselection()
+        if not index:
+            return
+        self.name_input.delete(0, END)
+        self.name_input.insert(0, self.top[index[0]]["name"])
+        self.show_food()
+
+    def show_food(self):
+
+        name = self.name_input.get().strip()
+        if not name:
+            return
+        start = self.start_date()
+        series = db.food_series(name, start, bucket=self.step.get())
+        self.shown = name
+        by = self.by.get()
+        self.graph.redraw([datetime.datetime.strptime(x["date"], "%Y-%m-%d") for x in series],
+                          [x[by] for x in series], self.STEP_DAYS[self.step.get()], by)
+        self.graph.set_title(f"{name} per {self.step.get()}")
+        freq = db.food_frequency(name, start)
+        if freq["days"]:
+            self.summary.configure(text=f"{freq['days']} days, {freq['per_week']:.1f} a week, last {freq['last']}")
+        else:
+            self.summary.configure(text=f"not eaten in {'all time' if start is None else self.period.get()}")
+
+    def changed(self, _=None):
+
+        self.show_top()
+        if self.shown:
+            self.show_food()
 
-        return dates, values
+    def on_state_change(self, changes):
+
+        """only entries inside the period can change the list, and only the shown food's can change the graph"""
+
+        start = self.start_date()
+        names = {name for name, date in changes["foods"] if start is None or date >= start}
+        if not names:
+            return
+        self.show_top()
+        if self.shown in names:
+            self.show_food()
 
 
 class RunningTotals(Frame):
@@ -257,6 +365,7 @@ class RunningTotals(Frame):
         self.title = Label(self, text="Today's consumption")
         self.title.pack(side=TOP)
         self.readings = {}
+        self.plan_readings = {}  # what today would come to with the plan eaten as well
         self.reading_values = {}
 
         self.label_con = Frame(self)
@@ -266,29 +375,249 @@ class RunningTotals(Frame):
             con = Frame(self.label_con)
             lab = Label(con, text=f"{x}:")
             lab.pack(side=LEFT)
+            lab3 = Label(con, text="", width=12, anchor=E)
+            lab3.pack(side=RIGHT)
             lab2 = Label(con, text=0)
             lab2.pack(side=RIGHT)
             self.readings[x] = lab2  # dictionary to look up label and change the displayed value
+            self.plan_readings[x] = lab3
             self.reading_values[x] = 0.0
             con.pack(side=TOP, fill=BOTH)
 
-        today_info = db.get_daily_totals(date="now")[0]  # read in the day's entries already made
+        self.plan = self._root().plan_session
+        self.state = self._root().day_state
+        self.state.subscribe(self.on_state_change, "totals")
+        self.show_totals()  # read in the day's entries already made
 
-        tmp = {}
-        for x in ["protein", "carbohydrate", "fat", "kcals"]:
-            val = today_info[f"sum({x})"]  # keys are different because we used and SQL sum query
-            tmp[x] = val
-        self.increment_displayed_values(tmp)
+    def on_state_change(self, changes):
+
+        if self.state.normalise_date("now") in changes["totals"]:
+            self.show_totals()
 
-    def increment_displayed_values(self, adict):
+    def show_totals(self):
 
-        """pass in a dict containing protein, carbohydrate, fat, kcals"""
+        """today's real totals, with the totals including the plan beside them if there is one"""
 
+        today_info = self.state.day_totals("now")
+        planned = self.plan.totals()
         for k in ["protein", "carbohydrate", "fat", "kcals"]:
-            old_val = self.reading_values[k]
-            new_val = old_val + float(adict[k])
-            self.readings[k].configure(text=round(new_val, 2))
-            self.reading_values[k] = new_val
+            self.readings[k].configure(text=round(today_info[k], 2))
+            self.reading_values[k] = today_info[k]
+            with_plan = f"(plan: {round(today_info[k] + planned[k], 2)})" if len(self.plan) else ""
+            self.plan_readings[k].configure(text=with_plan)
+
+
+class GoalsPanel(Frame, LoggingMixIn):
+
+    """daily targets, and for each one today's target after the rest of the week so far, the current and
+    longest streak of days meeting it and how far over or under it all the days since it was set come to.
+    The database keeps these up to date as entries are made (see db.goal_progress), so showing them only
+    reads a few rows."""
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+        self.title = Label(self, text="Goals")
+        self.title.pack(side=TOP)
+        self.targets = {}
+        self.modes = {}
+        self.status = {}
+        for k in db.NUTRIENTS:
+            con = Frame(self)
+            lab = Label(con, text=k[:4], width=5, anchor=W)
+            lab.pack(side=LEFT)
+            self.modes[k] = StringVar(self, db.DEFAULT_GOAL_MODES[k])
+            menu = OptionMenu(con, self.modes[k], *db.GOAL_MODES)
+            menu.configure(width=7)
+            menu.pack(side=LEFT)
+            self.targets[k] = Entry(con, width=6)
+            self.targets[k].pack(side=LEFT)
+            self.status[k] = Label(con, text="", anchor=W)
+            self.status[k].pack(side=LEFT, fill=X)
+            con.pack(side=TOP, fill=X)
+        Button(self, text="Set goals", command=self.set_goals).pack(side=TOP)
+
+        self.state = self._root().day_state
+        self.state.subscribe(self.on_state_change, "totals")
+        self.load()
+
+    def load(self):
+
+        """fill the boxes in from the goals saved for the current profile"""
+
+        goals = db.get_goals()
+        for k in db.NUTRIENTS:
+            self.targets[k].delete(0, END)
+            if k in goals:
+                self.targets[k].insert(0, f"{goals[k]['target']:g}")
+                self.modes[k].set(goals[k]["mode"])
+            else:
+                self.modes[k].set(db.DEFAULT_GOAL_MODES[k])
+        self.show()
+
+    def set_goals(self):
+
+        """a blank box clears that goal"""
+
+        goals = db.get_goals()
+        try:
+            targets = {k: float(e.get()) if e.get().strip() else None for k, e in self.targets.items()}
+        except ValueError:
+            self.log("Goals must be numbers")
+            return
+        for k, target in targets.items():
+            if target is None:
+                if k in goals:
+                    db.clear_goal(k)
+                    self.log(f"Cleared the {k} goal.")
+            elif k not in goals or (goals[k]["target"], goals[k]["mode"]) != (target, self.modes[k].get()):
+                db.set_goal(k, target, self.modes[k].get())
+                self.log(f"Set the {k} goal to {self.modes[k].get()} {target:g}.")
+        self.show()
+
+    def on_state_change(self, changes):
+
+        # an edit to an earlier day can change the streaks and the week, so any change is worth showing
+        self.show()
+
+    def show(self):
+
+        progress = db.goal_progress()
+        for k in db.NUTRIENTS:
+            p = progress.get(k)
+            if p is None:
+                self.status[k].configure(text="")
+                continue
+            self.status[k].configure(text=f"today {round(p['day_target'])}, "
+                                          f"streak {p['streak']} (best {p['best_streak']}), "
+                                          f"{p['met_days']}/{p['days']} days, {p['surplus']:+.0f}")
+
+
+class PlanPanel(Frame, LoggingMixIn):
+
+    """the foods in the current plan, which can be taken out one at a time, eaten all at once or thrown
+    away. The numbers are kept in the root's PlanSession."""
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+        self.session = self._root().plan_session
+        self.ids = []  # session item id for each line of the listbox
+
+        self.title = Label(self, text="Plan")
+        self.title.pack(side=TOP)
+        self.lb = Listbox(self, exportselection=0, height=4)
+        self.lb.pack(side=TOP, fill=BOTH, expand=YES)
+        con = Frame(self)
+        for text, command in (("Remove", self.remove), ("Eat plan", self.commit), ("Clear", self.clear)):
+            Button(con, text=text, command=command).pack(side=LEFT)
+        con.pack(side=TOP)
+
+    def add(self, tup, nutrition=None):
+
+        name, amount, unit = tup
+        self.ids.append(self.session.add(tup, nutrition))
+        self.lb.insert(END, f"{name}: {amount} {unit}")
+        self.changed()
+
+    def remove(self):
+
+        index = self.lb.curselection()
+        if not index:
+            self.log("No plan item selected")
+            return
+        name, amount, unit = self.session.remove(self.ids.pop(index[0]))
+        self.lb.delete(index[0])
+        self.log(f"Took {name}: {amount} {unit} out of the plan.")
+        self.changed()
+
+    def commit(self):
+
+        if not len(self.session):
+            self.log("The plan is empty")
+            return
+        n = self.session.commit()  # the day state updates the totals and graphs once for the lot
+        self.lb.delete(0, END)
+        self.ids = []
+        self.log(f"Consumed {n} planned items.")
+        self.changed()
+
+    def clear(self):
+
+        self.session.clear()
+        self.lb.delete(0, END)
+        self.ids = []
+        self.changed()
+
+    def changed(self):
+
+        self._root().app.running_totals.show_totals()
+
+
+class MealPlanner(Frame, LoggingMixIn):
+
+    """takes the day's targets and suggests portions of recipes and often eaten foods that make up what's
+    left of them after today's entries, see planner.py. A chosen plan is added to the plan panel."""
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+        self.plans = []
+        self.title = Label(self, text="Meal planner: daily targets")
+        self.title.pack(side=TOP)
+
+        con = Frame(self)
+        self.targets = {}
+        for k in db.NUTRIENTS:
+            lab = Label(con, text=k[:4])
+            lab.pack(side=LEFT)
+            self.targets[k] = Entry(con, width=5)
+            self.targets[k].pack(side=LEFT)
+        con.pack(side=TOP)
+
+        self.lb = Listbox(self, exportselection=0, height=5, width=50)
+        self.lb.pack(side=TOP, fill=BOTH, expand=YES)
+        con = Frame(self)
+        Button(con, text="Plan", command=self.make_plans).pack(side=LEFT)
+        Button(con, text="Use plan", command=self.use_plan).pack(side=LEFT)
+        con.pack(side=TOP)
+        self.state = self._root().day_state
+
+    def make_plans(self):
+
+        """targets left blank don't count"""
+
+        eaten = self.state.day_totals("now")
+        remaining = {}
+        try:
+            for k, entry in self.targets.items():
+                if entry.get().strip():
+                    remaining[k] = float(entry.get()) - eaten[k]
+        except ValueError:
+            self.log("Targets must be numbers")
+            return
+        if not remaining:
+            self.log("Enter at least one target")
+            return
+
+        self.plans = planner.plan(remaining, planner.CandidatePool())
+        self.lb.delete(0, END)
+        for p in self.plans:
+            foods = " + ".join(f"{name} {amount:g} {unit}" for name, amount, unit in p["items"])
+            self.lb.insert(END, f"{foods} ({round(p['totals']['kcals'])} kcal)")
+        if not self.plans:
+            self.log("No recipes or foods eaten before to plan with")
+
+    def use_plan(self):
+
+        index = self.lb.curselection()
+        if not index:
+            self.log("No plan selected")
+            return
+        chosen = self.plans[index[0]]
+        for (name, amount, unit), nutrition in zip(chosen["items"], chosen["nutrition"]):
+            self._root().app.plan_panel.add((name, amount, unit), nutrition)
+            self.log(f"Added {name}: {amount:g} {unit} to the plan.")
 
 
 class WeighIn(Frame, LoggingMixIn):
@@ -303,21 +632,136 @@ class WeighIn(Frame, LoggingMixIn):
         self.entry.pack(side=LEFT)
         button.pack(side=LEFT)
 
-        weight_today = db.get_today_weight()
+        self.button = button
+        self.state = self._root().day_state
+        self.state.subscribe(self.on_state_change, "weight")
+        weight_today = self.state.day_weight("now")
         # check if the user has already entered a weight today, if so, display it and disable the entry
 
-        if weight_today:
-            a = weight_today["weighin"]
-            self.entry.insert(0, a)
+        if weight_today is not None:
+            self.show_weight(weight_today)
+
+    def on_state_change(self, changes):
+
+        if self.state.normalise_date("now") in changes["weight"]:
+            self.show_weight(self.state.day_weight("now"))
+
+    def show_weight(self, weight):
+
+        """display today's weight and stop another being entered, or reopen the entry if it was deleted"""
+
+        self.entry.config(state=NORMAL)
+        self.button.config(state=NORMAL)
+        self.entry.delete(0, END)
+        if weight is not None:
+            self.entry.insert(0, weight)
             self.entry.config(state=DISABLED)
-            button.config(state=DISABLED)
+            self.button.config(state=DISABLED)
 
     def submit_weight(self):
 
         val = self.entry.get()
         db.enter_weight(val)
         self.log(f"entered weigh-in {val} kg into the db")
-        self.entry.delete(0, END)
+
+
+class EntryEditor(Frame, LoggingMixIn):
+
+    """lists the consumption and weight entries for one day so that a mistyped amount can be changed or an
+    entry deleted, with an undo button that steps back through the changes one at a time"""
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+        self.date = "now"
+        self.rows = []  # (table, row) for each line in the listbox, in the same order
+
+        self.title = Label(self, text="Today's entries")
+        self.title.pack(side=TOP)
+        self.lb = Listbox(self, exportselection=0, height=8)
+        self.lb.pack(side=TOP, fill=BOTH, expand=YES)
+        self.lb.bind("<<ListboxSelect>>", self.on_select)
+
+        con = Frame(self)
+        lab = Label(con, text="amount:")
+        lab.pack(side=LEFT)
+        self.amount_entry = Entry(con, width=6)
+        self.amount_entry.pack(side=LEFT)
+        for text, command in (("Update", self.update_entry), ("Delete", self.delete_entry), ("Undo", self.undo)):
+            Button(con, text=text, command=command).pack(side=LEFT)
+        con.pack(side=TOP)
+
+        self.state = self._root().day_state
+        self.state.subscribe(self.on_state_change, "entries")
+        self.show_day(self.date)
+
+    def on_state_change(self, changes):
+
+        if self.state.normalise_date(self.date) in changes["entries"]:
+            self.show_day(self.date)
+
+    def show_day(self, date):
+
+        self.date = date
+        self.title.configure(text="Today's entries" if date == "now" else f"Entries for {date}")
+        entries = self.state.day_entries(date)
+        self.lb.delete(0, END)
+        self.rows = []
+        for (table, _), row in sorted(entries.items(), key=lambda x: (x[0][0], x[1]["entry_time"], x[0][1])):
+            if table == "consumption":
+                self.lb.insert(END, f"{row['name']}: {row['amount']} {row['unit']} ({round(row['kcals'])} kcal)")
+            else:
+                self.lb.insert(END, f"weigh-in: {row['weighin']} kg")
+            self.rows.append((table, row))
+
+    def selected(self):
+
+        index = self.lb.curselection()
+        if not index:
+            self.log("No entry selected")
+            return None, None
+        return self.rows[index[0]]
+
+    def on_select(self, e):
+
+        table, row = self.selected()
+        if row:
+            self.amount_entry.delete(0, END)
+            self.amount_entry.insert(0, row["amount"] if table == "consumption" else row["weighin"])
+
+    def update_entry(self):
+
+        table, row = self.selected()
+        if not row:
+            return
+        val = self.amount_entry.get()
+        if table == "consumption":
+            db.update_consumption(row["id"], (row["name"], val, row["unit"]))
+            self.log(f"Changed {row['name']} from {row['amount']} to {val} {row['unit']}.")
+        else:
+            db.update_weight(row["id"], val)
+            self.log(f"Changed weigh-in from {row['weighin']} to {val} kg.")
+        self.amount_entry.delete(0, END)
+
+    def delete_entry(self):
+
+        table, row = self.selected()
+        if not row:
+            return
+        if table == "consumption":
+            db.delete_consumption(row["id"])
+            self.log(f"Deleted {row['name']}: {row['amount']} {row['unit']}.")
+        else:
+            db.delete_weight(row["id"])
+            self.log(f"Deleted weigh-in of {row['weighin']} kg.")
+
+    def undo(self):
+
+        change = db.undo()
+        if change is None:
+            self.log("Nothing to undo")
+            return
+        self.log(f"Undid the last change to {change['table']} on {change['date']}.")
 
 
 class IngredientAdder(Frame, LoggingMixIn):
@@ -329,7 +773,7 @@ class IngredientAdder(Frame, LoggingMixIn):
         title = Label(self, text="Enter new ingredient:")
         title.pack(side=TOP)
         self.entries = {}  # dict to look up values in the entry boxes
-        for x in ["name", "kcals", "fat", "carbohydrate", "protein", "unit", "serving_size", "container_name"]:
+        for x in ["name", "kcals", "fat", "carbohydrate", "protein", "unit", "serving_size", "container_name", "density"]:
             con = Frame(self)
             lab = Label(con, text=x)
             lab.pack(side=LEFT)
@@ -344,7 +788,7 @@ class IngredientAdder(Frame, LoggingMixIn):
 
         out = {}
 
-        for x in ["name", "kcals", "fat", "carbohydrate", "protein", "unit", "serving_size", "container_name"]:
+        for x in ["name", "kcals", "fat", "carbohydrate", "protein", "unit", "serving_size", "container_name", "density"]:
             value = self.entries[x].get()
             out[x] = value
             self.entries[x].delete(0, END)
@@ -356,17 +800,120 @@ class IngredientAdder(Frame, LoggingMixIn):
         self.master.master.entry_boxes.refresh_autocompletes()  # master is the top level frame
 
 
+class AutocompleteList:
+
+    """keeps a Listbox showing the names that match what has been typed. The matches are held here, so
+    looking up the selected name doesn't go back to Tk, only the first WINDOW of them are put in the
+    Listbox (more are added as it is scrolled to the end), and a new filter only deletes and inserts the
+    rows that are different from what is already shown."""
+
+    WINDOW = 60  # rows put in the listbox at a time
+    SPECIAL = frozenset(".^$*+?{}[]\\|()")  # characters that make a typed filter more than plain text
+
+    def __init__(self, listbox, names):
+
+        self.lb = listbox
+        self.lb.configure(yscrollcommand=self.on_scroll)
+        self.names = []
+        self.partial = ""
+        self.matches = []  # every name matching partial, in display order
+        self.shown = []  # the rows in the listbox, always the start of matches
+        self.index = None  # selected position in matches
+        self.set_names(names)
+
+    def set_names(self, names):
+
+        # the lists used to be filled by inserting each name at the top, so they show in reverse
+        self.names = list(reversed(names))
+        self.partial = None  # so filter() can't narrow down from the old list
+        self.filter("")
+
+    def filter(self, partial):
+
+        """show the names that partial (a regular expression, as it was typed) finds"""
+
+        try:
+            pattern = re.compile(partial)
+        except re.error:
+            pattern = re.compile(re.escape(partial))  # halfway through typing something like "(" or "["
+        if self.partial is not None and partial.startswith(self.partial) and \
+                not self.SPECIAL.intersection(partial):
+            # plain text that only got longer can only match a subset of what it matched before
+            source = self.matches
+        else:
+            source = self.names
+        self.partial = partial
+        self.matches = [x for x in source if pattern.search(x)]
+        self._sync(self.matches[:self.WINDOW])
+        self.select(0 if self.matches else None)
+
+    def _sync(self, rows):
+
+        """make the listbox hold rows, changing only the part in the middle that differs"""
+
+        old = self.shown
+        start = 0
+        while start < len(old) and start < len(rows) and old[start] == rows[start]:
+            start += 1
+        end = 0
+        while end < len(old) - start and end < len(rows) - start and old[-1 - end] == rows[-1 - end]:
+            end += 1
+        if len(old) - end > start:
+            self.lb.delete(start, len(old) - end - 1)
+        if len(rows) - end > start:
+            self.lb.insert(start, *rows[start:len(rows) - end])
+        self.shown = list(rows)
+
+    def extend(self, upto=None):
+
+        """add the next WINDOW matches to the listbox, or enough to show position upto"""
+
+        n = max(len(self.shown) + self.WINDOW, (upto or 0) + 1)
+        if len(self.shown) < len(self.matches):
+            more = self.matches[len(self.shown):n]
+            self.lb.insert(END, *more)
+            self.shown.extend(more)
+
+    def on_scroll(self, first, last):
+
+        if float(last) > 0.9 and len(self.shown) < len(self.matches):
+            self.lb.after_idle(self.extend)
+
+    def select(self, index):
+
+        # clear every row, the diff in _sync keeps rows (and Tk keeps their selection) at a new index
+        self.lb.selection_clear(0, END)
+        self.index = index
+        if index is None:
+            return
+        if index >= len(self.shown):
+            self.extend(index)
+        self.lb.selection_set(index)
+        self.lb.see(index)
+
+    def move(self, step):
+
+        """move the selection up or down, going round from one end to the other"""
+
+        if self.matches:
+            self.select(((self.index or 0) + step) % len(self.matches))
+
+    def selected(self):
+
+        return self.matches[self.index] if self.index is not None else None
+
+
 class MyEntryBoxes(Frame):
 
     """three text entry boxes, item name, amount, and unit"""
 
+    DEBOUNCE_MS = 150  # how long typing has to pause for before the lists are filtered
+
     def __init__(self, *args, **kwargs):
 
         super().__init__(*args, **kwargs)
         self.cont1 = Frame(self)
         self.cont2 = Frame(self)
-        self.ingredient_autocompletes = db.get_all_ingredient_names()
-        self.recipe_autocompletes = db.get_all_recipe_names()
 
         for label in ("name", "amount", "unit"):
             la = Label(self.cont2)
@@ -404,68 +951,72 @@ class MyEntryBoxes(Frame):
         self.speculative_container.pack(side=TOP)
 
         self.content = ""
+        self.backspace = False
+        self.pending = None  # the after() id of a filter waiting for typing to pause
         self.unit = None
         self.vessel = None
 
         self.lb = Listbox(self, exportselection=0)
         self.lb.pack(side=TOP, fill=BOTH, expand=YES, pady=10)
-        for word in self.ingredient_autocompletes:
-            self.lb.insert(0, word)
-        self.lb.selection_set(0)
+        self.ingredients = AutocompleteList(self.lb, db.get_all_ingredient_names())
 
         self.recipe_box = Listbox(self, exportselection=0)
         self.recipe_box.pack(side=TOP, fill=BOTH, expand=YES)
-        for word in db.get_all_recipe_names():
-            self.recipe_box.insert(0, word)
-        self.recipe_box.selection_set(0)
+        self.recipes = AutocompleteList(self.recipe_box, db.get_all_recipe_names())
         # !!ONLY ONE LIST BOX CAN HAVE AN ACTIVE SELECTION AT ONE TIME!! #
         # exportselection=0 overrides this behaviour
 
-    def refresh(self, listbox, lst, partial):
-
-        """fill a listbox with items from list only if they contain the string partial"""
-
-        listbox.delete(0, END)
-        for x in lst:
-            if re.search(partial, x):
-                listbox.insert(0, x)
-        listbox.selection_set(0)
-
     def refresh_autocompletes(self):
 
-        self.ingredient_autocompletes = db.get_all_ingredient_names()
-        self.recipe_autocompletes = db.get_all_recipe_names()
+        self.ingredients.set_names(db.get_all_ingredient_names())
+        self.recipes.set_names(db.get_all_recipe_names())
+        self.update_matches()
 
     def te_function(self, e):
 
-        if e.keycode == 40 or e.keycode == 38:
-            # up is 38, dn is 40
+        if e.keycode in (9, 38, 40):
+            # tab, up, down
             return
 
-        if not e.keycode == 9:  # tab
-            self.content = e.widget.get()
-            for box, lst in zip((self.lb, self.recipe_box),
-                                (self.ingredient_autocompletes, self.recipe_autocompletes)):
-                self.refresh(box, lst, self.content)
+        self.content = e.widget.get()
+        self.backspace = e.keycode == 8
+        if self.pending:
+            self.after_cancel(self.pending)
+        self.pending = self.after(self.DEBOUNCE_MS, self.update_matches)
+
+    def update_matches(self):
 
-            options = self.lb.get(0, END) + self.recipe_box.get(0, END)
+        """filter both lists by what has been typed so far, and fill in the name if there's only one
+        match left (unless the last key was backspace)"""
 
-            if not e.keycode == 8:  # backspace
-                if len(options) == 1:
-                    e.widget.delete(0, END)
-                    e.widget.insert(0, options[0])
+        self.pending = None
+        self.ingredients.filter(self.content)
+        self.recipes.filter(self.content)
+        options = self.ingredients.matches + self.recipes.matches
+        if not self.backspace and len(options) == 1:
+            self.name_entry.delete(0, END)
+            self.name_entry.insert(0, options[0])
+
+    def flush(self):
+
+        """filter straight away if typing stopped less than DEBOUNCE_MS ago, before using the lists"""
+
+        if self.pending:
+            self.after_cancel(self.pending)
+            self.update_matches()
 
     def te_tab_down(self, e):
 
         """autocompletes the selected ingredient, and fills in the unit option in the unit field"""
 
-        index = self.lb.curselection()  # it's a tuple of indexes always of length 1, so get the first
-        if index:
-            name = self.lb.get(0, END)[index[0]]  # get all items, then look up by index
-        else:
-            # index is an empty tuple if no selection i.e. the list has been filtered so there is nothing
-            # displayed and the user wants something from the recipe list
-            name = self.recipe_box.get(0, END)[0]  # just get the first thing from the recipe list
+        self.flush()
+        name = self.ingredients.selected()
+        if name is None:
+            # no selection i.e. the list has been filtered so there is nothing displayed and the user
+            # wants something from the recipe list
+            if not self.recipes.matches:
+                return
+            name = self.recipes.matches[0]  # just get the first thing from the recipe list
 
         e.widget.delete(0, END)
         e.widget.insert(0, name)
@@ -500,21 +1051,13 @@ class MyEntryBoxes(Frame):
 
     def te_arrow(self, e):
 
-        current = self.lb.curselection()  # a tuple of indexes, so the first item is (0,)
-        ind = current[0]
-        all_items = list(self.lb.get(0, END))
-        self.lb.selection_clear(0, END)
+        self.flush()
         if e.keycode == 38:
             # up
-            ind -= 1
-            if ind < 0:
-                ind = len(all_items) - 1
+            self.ingredients.move(-1)
         elif e.keycode == 40:
             # down
-            ind += 1
-            if ind >= len(all_items):
-                ind = 0
-        self.lb.selection_set(ind)
+            self.ingredients.move(1)
 
     def get_content(self):
 
@@ -561,6 +1104,9 @@ class MyRoot(Tk):
         super().__init__(*args, **kwargs)
         self.title("Calorie counter")
         self.console = None  # when a console is created, it registers itself with the root object
+        self.day_state = DayState(schedule=self.after_idle)
+        # every widget showing daily numbers reads them from here and is told when they change
+        self.plan_session = planner.PlanSession()  # speculative entries, shown beside the real totals
         self.app = App(self)  # the main window frame containing all other frames
         self.app.pack()
 
@@ -578,7 +1124,9 @@ class MyRoot(Tk):
 
         self.app.graph_window.show_calorie_split_chart(date)
         self.app.graph_window.show_macro_split_chart(date)
+        self.app.entry_editor.show_day(date)
 
 
-root = MyRoot()
-root.mainloop()
+if __name__ == "__main__":
+    root = MyRoot()
+    root.mainloop()
@@ -0,0 +1,464 @@
+"""numbered schema migrations. The database records how many have been applied in PRAGMA user_version and
+migrate() runs whatever is missing in order, so an existing db.sqlite3 is brought up to date in place
+when the app starts instead of being recreated from schema.sql.
+
+With profiles (see db.connect) the tables are split over two kinds of file, a shared catalogue with the
+ingredients and recipes and one file per person with everything else, so each migration is told which
+role the file has and only makes the tables that belong in it. A plain db.sqlite3 has the role "all"."""
+
+import os
+import re
+import hashlib
+import units
+
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+
+CATALOGUE_TABLES = ("ingredients", "recipes")
+PROFILE_TABLES = ("consumption", "weight", "daily_totals", "journal", "consumption_archive", "goals", "goal_days",
+                  "goal_stats", "food_rollup", "archived_uuids")
+# settings, changelog and sync_peers are in every file, each file is synced on its own
+
+
+def wanted(role, table):
+
+    """whether a file with this role has the table"""
+
+    if role == "catalogue":
+        return table in CATALOGUE_TABLES
+    if role == "profile":
+        return table not in CATALOGUE_TABLES
+    return True
+
+
+def detect_role(conn):
+
+    """the role of an existing file from the tables it has, for opening a file without being told what it is"""
+
+    names = {x[0] for x in conn.execute('''SELECT name FROM sqlite_master WHERE type = 'table' ''')}
+    if "ingredients" in names and "consumption" not in names:
+        return "catalogue"
+    if "consumption" in names and "ingredients" not in names:
+        return "profile"
+    return "all"
+
+
+def _statements(script):
+
+    """split a script of plain CREATE statements (no triggers) into single statements so they can be run
+    inside the migration's transaction, executescript() would commit on its own"""
+
+    lines = [x for x in script.splitlines() if not x.strip().startswith("--")]
+    return [x.strip() for x in "\n".join(lines).split(";") if x.strip()]
+
+
+_LEADING_NUMBER = re.compile(r"\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)")
+
+
+def _is_number(val):
+
+    try:
+        float(val)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def _to_real(val):
+
+    """old rows can hold numbers as text, empty strings from blank entry boxes, or free text like "400g"
+    from the old ingredient form, which is read as the number it starts with. None if there isn't one."""
+
+    if val is None or val == "":
+        return None
+    if isinstance(val, (int, float)):
+        return float(val)
+    m = _LEADING_NUMBER.match(str(val))
+    return float(m.group(1)) if m else None
+
+
+def m001_baseline(conn, role):
+
+    """the original tables, does nothing to a database that was made from the old schema.sql"""
+
+    with open(SCHEMA_PATH, "r") as f:
+        for stmt in _statements(f.read()):
+            table = re.search(r"CREATE TABLE (?:IF NOT EXISTS )?(\w+)", stmt).group(1)
+            if wanted(role, table):
+                conn.execute(stmt)
+
+
+def m002_typed_columns(conn, role):
+
+    """rebuild the tables with proper column types. serving_size was TEXT and the timestamps had no type,
+    ingredients get the unit and container factors worked out up front and the logs get an integer
+    day number (days since 1970-01-01) so date filters can use an index instead of date(entry_time)"""
+
+    if wanted(role, "ingredients"):
+        _typed_ingredients(conn)
+    if wanted(role, "consumption"):
+        _typed_logs(conn)
+
+
+def _typed_ingredients(conn):
+
+    conn.execute('''CREATE TABLE ingredients_new (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT UNIQUE NOT NULL,
+                    protein REAL,
+                    carbohydrate REAL,
+                    fat REAL,
+                    kcals REAL,
+                    unit TEXT,
+                    serving_size REAL,
+                    container_name TEXT,
+                    density REAL,
+                    unit_factor REAL,
+                    container_factor REAL,
+                    serving_text TEXT
+                    )''')
+    rows = conn.execute('''SELECT id, name, protein, carbohydrate, fat, kcals, unit, serving_size, container_name
+                           FROM ingredients''').fetchall()
+    for row in rows:
+        iid, name, pro, carb, fat, kcal, unit, serving_raw, container = tuple(row)
+        serving = _to_real(serving_raw)
+        # free text that isn't just a number is kept as it was typed in serving_text
+        text = None if serving_raw in (None, "") or _is_number(serving_raw) else str(serving_raw)
+        conn.execute('''INSERT INTO ingredients_new (id, name, protein, carbohydrate, fat, kcals, unit,
+                        serving_size, container_name, unit_factor, container_factor, serving_text)
+                        VALUES (?,?,?,?,?,?,?,?,?,?,?,?)''',
+                     (iid, name, _to_real(pro), _to_real(carb), _to_real(fat), _to_real(kcal), unit or None,
+                      serving, container or None, units.own_factor(unit), units.container_factor(unit, serving),
+                      text))
+    conn.execute('''DROP TABLE ingredients''')
+    conn.execute('''ALTER TABLE ingredients_new RENAME TO ingredients''')
+
+
+def _typed_logs(conn):
+
+    conn.execute('''CREATE TABLE consumption_new (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT,
+                    amount REAL,
+                    unit TEXT,
+                    protein REAL,
+                    carbohydrate REAL,
+                    fat REAL,
+                    kcals REAL,
+                    entry_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    entry_day INTEGER GENERATED ALWAYS AS (CAST(julianday(entry_time) - 2440587.5 AS INTEGER)) STORED
+                    )''')
+    conn.execute('''INSERT INTO consumption_new (id, name, amount, unit, protein, carbohydrate, fat, kcals, entry_time)
+                    SELECT id, name, CAST(amount AS REAL), unit, CAST(protein AS REAL), CAST(carbohydrate AS REAL),
+                    CAST(fat AS REAL), CAST(kcals AS REAL), entry_time FROM consumption''')
+    conn.execute('''DROP TABLE consumption''')
+    conn.execute('''ALTER TABLE consumption_new RENAME TO consumption''')
+    conn.execute('''CREATE INDEX consumption_day ON consumption (entry_day)''')
+
+    conn.execute('''CREATE TABLE weight_new (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    weighin REAL,
+                    entry_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    entry_day INTEGER GENERATED ALWAYS AS (CAST(julianday(entry_time) - 2440587.5 AS INTEGER)) STORED
+                    )''')
+    conn.execute('''INSERT INTO weight_new (id, weighin, entry_time)
+                    SELECT id, CAST(weighin AS REAL), entry_time FROM weight''')
+    conn.execute('''DROP TABLE weight''')
+    conn.execute('''ALTER TABLE weight_new RENAME TO weight''')
+    conn.execute('''CREATE INDEX weight_day ON weight (entry_day)''')
+
+
+def m003_daily_totals_and_journal(conn, role):
+
+    """per-day sums of the consumption table, kept up to date by applying the difference every time a row is
+    added, changed or removed, and a journal of those changes so they can be undone one at a time"""
+
+    if not wanted(role, "daily_totals"):
+        return
+
+    conn.execute('''CREATE TABLE daily_totals (
+                    entry_day INTEGER PRIMARY KEY,
+                    protein REAL NOT NULL DEFAULT 0,
+                    carbohydrate REAL NOT NULL DEFAULT 0,
+                    fat REAL NOT NULL DEFAULT 0,
+                    kcals REAL NOT NULL DEFAULT 0
+                    )''')
+    conn.execute('''INSERT INTO daily_totals (entry_day, protein, carbohydrate, fat, kcals)
+                    SELECT entry_day, total(protein), total(carbohydrate), total(fat), total(kcals)
+                    FROM consumption WHERE entry_day IS NOT NULL GROUP BY entry_day''')
+
+    conn.execute('''CREATE TABLE journal (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    op TEXT NOT NULL,
+                    tbl TEXT NOT NULL,
+                    row_id INTEGER NOT NULL,
+                    before TEXT,
+                    after TEXT,
+                    entry_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )''')
+
+
+# one row per food per day, made by archiving old consumption rows. Also created in a separate archive
+# file when one is used, hence the schema placeholder
+ARCHIVE_TABLE = '''CREATE TABLE IF NOT EXISTS {schema}.consumption_archive (
+                    entry_day INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    unit TEXT NOT NULL DEFAULT '',
+                    amount REAL NOT NULL DEFAULT 0,
+                    protein REAL NOT NULL DEFAULT 0,
+                    carbohydrate REAL NOT NULL DEFAULT 0,
+                    fat REAL NOT NULL DEFAULT 0,
+                    kcals REAL NOT NULL DEFAULT 0,
+                    entries INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (entry_day, name, unit)
+                    ) WITHOUT ROWID'''
+ARCHIVE_INDEX = '''CREATE INDEX IF NOT EXISTS {schema}.consumption_archive_name
+                   ON consumption_archive (name, entry_day)'''
+
+
+def m004_archive(conn, role):
+
+    """summary table for archived consumption, and a key/value settings table to remember where the
+    archive file is, if there is one"""
+
+    if wanted(role, "consumption_archive"):
+        conn.execute(ARCHIVE_TABLE.format(schema="main"))
+    conn.execute('''CREATE TABLE settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                    )''')
+
+
+SYNCED_TABLES = ("ingredients", "recipes", "consumption", "weight")
+
+# columns that identify a row that existed before rows had uuids, so two copies of the same database get the
+# same uuids for the same rows when they are migrated separately
+_IDENTITY = {"ingredients": ("name",),
+             "recipes": ("name", "composition_string"),
+             "consumption": ("name", "amount", "unit", "entry_time"),
+             "weight": ("weighin", "entry_time")}
+
+
+def sync_triggers(table):
+
+    """triggers that give every new row a uuid and record every insert, update and delete in the changelog,
+    stamped with this database's site id"""
+
+    site = '''(SELECT value FROM settings WHERE key = 'site_id')'''
+    return [f'''CREATE TRIGGER {table}_log_insert AFTER INSERT ON {table} BEGIN
+                UPDATE {table} SET uuid = lower(hex(randomblob(16))) WHERE id = NEW.id AND uuid IS NULL;
+                INSERT INTO changelog (tbl, uuid, op, origin)
+                SELECT '{table}', uuid, 'upsert', {site} FROM {table} WHERE id = NEW.id;
+                END''',
+            f'''CREATE TRIGGER {table}_log_update AFTER UPDATE ON {table} WHEN OLD.uuid IS NOT NULL BEGIN
+                INSERT INTO changelog (tbl, uuid, op, origin) VALUES ('{table}', NEW.uuid, 'upsert', {site});
+                END''',
+            f'''CREATE TRIGGER {table}_log_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO changelog (tbl, uuid, op, origin) VALUES ('{table}', OLD.uuid, 'delete', {site});
+                END''']
+
+
+def m005_sync(conn, role):
+
+    """stable row uuids, a changelog of every change to the synced tables and a record of how far each other
+    copy of the database has been synced, for sync.py"""
+
+    conn.execute('''INSERT INTO settings (key, value) VALUES ('site_id', lower(hex(randomblob(16))))''')
+    conn.execute('''CREATE TABLE changelog (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tbl TEXT NOT NULL,
+                    uuid TEXT NOT NULL,
+                    op TEXT NOT NULL,
+                    ts TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+                    origin TEXT NOT NULL
+                    )''')
+    conn.execute('''CREATE INDEX changelog_row ON changelog (tbl, uuid)''')
+    conn.execute('''CREATE TABLE sync_peers (
+                    site_id TEXT PRIMARY KEY,
+                    sent_seq INTEGER NOT NULL DEFAULT 0,
+                    received_seq INTEGER NOT NULL DEFAULT 0
+                    )''')
+
+    site = conn.execute('''SELECT value FROM settings WHERE key = ?''', ("site_id",)).fetchone()[0]
+    for table in (x for x in SYNCED_TABLES if wanted(role, x)):
+        conn.execute(f'''ALTER TABLE {table} ADD COLUMN uuid TEXT''')
+        cols = _IDENTITY[table]
+        seen = {}
+        for row in conn.execute(f'''SELECT id, {", ".join(cols)} FROM {table} ORDER BY id''').fetchall():
+            key = repr(tuple(row)[1:])
+            seen[key] = seen.get(key, 0) + 1  # identical rows are told apart by how many came before
+            uuid = hashlib.sha1(f"{table}|{key}|{seen[key]}".encode()).hexdigest()[:32]
+            conn.execute(f'''UPDATE {table} SET uuid = ? WHERE id = ?''', (uuid, row[0]))
+        conn.execute(f'''CREATE UNIQUE INDEX {table}_uuid ON {table} (uuid)''')
+        conn.execute(f'''INSERT INTO changelog (tbl, uuid, op, origin) SELECT ?, uuid, 'upsert', ? FROM {table}''',
+                     (table, site))
+        for trigger in sync_triggers(table):
+            conn.execute(trigger)
+
+
+def m006_goals(conn, role):
+
+    """daily targets, and for every day since a target was set, whether it was met and how many days in a
+    row it had been met up to then, plus running counts per target. db keeps them up to date one day at a
+    time as entries change, the same way as daily_totals."""
+
+    if not wanted(role, "goals"):
+        return
+    conn.execute('''CREATE TABLE goals (
+                    nutrient TEXT PRIMARY KEY,
+                    target REAL NOT NULL,
+                    mode TEXT NOT NULL DEFAULT 'around',
+                    tolerance REAL NOT NULL DEFAULT 0.1,
+                    since INTEGER NOT NULL
+                    )''')
+    conn.execute('''CREATE TABLE goal_days (
+                    nutrient TEXT NOT NULL,
+                    entry_day INTEGER NOT NULL,
+                    value REAL NOT NULL,
+                    met INTEGER NOT NULL,
+                    run INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (nutrient, entry_day)
+                    ) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE goal_stats (
+                    nutrient TEXT PRIMARY KEY,
+                    days INTEGER NOT NULL DEFAULT 0,
+                    met INTEGER NOT NULL DEFAULT 0,
+                    total REAL NOT NULL DEFAULT 0,
+                    best_run INTEGER NOT NULL DEFAULT 0
+                    )''')
+
+
+def name_key(name):
+
+    """an ingredient name with case, spacing and punctuation ignored, so "Chicken breast, raw" and
+    "chicken breast raw" have the same key"""
+
+    return " ".join(re.sub(r"[\W_]+", " ", str(name).lower()).split())
+
+
+def content_key(protein, carbohydrate, fat, kcals, unit):
+
+    """a short hash of an ingredient's nutrition, rounded to what a label gives, and the unit it's per. None
+    for an ingredient with no nutrition filled in, those aren't the same food as each other."""
+
+    vals = (protein, carbohydrate, fat, kcals)
+    if all(x is None for x in vals):
+        return None
+    text = "|".join("" if x is None else f"{float(x):.1f}" for x in vals) + "|" + (units.normalise(unit) or "")
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def m007_dedupe_keys(conn, role):
+
+    """indexed name_key and content_key columns on the ingredients, for finding the same food entered more
+    than once (see dedupe.py) without comparing every pair"""
+
+    if not wanted(role, "ingredients"):
+        return
+    conn.execute('''ALTER TABLE ingredients ADD COLUMN norm_name TEXT''')
+    conn.execute('''ALTER TABLE ingredients ADD COLUMN content_hash TEXT''')
+    last_seq = conn.execute('''SELECT coalesce(max(seq), 0) FROM changelog''').fetchone()[0]
+    rows = conn.execute('''SELECT id, name, protein, carbohydrate, fat, kcals, unit FROM ingredients''').fetchall()
+    conn.executemany('''UPDATE ingredients SET norm_name = ?, content_hash = ? WHERE id = ?''',
+                     [(name_key(r[1]), content_key(*r[2:]), r[0]) for r in rows])
+    # every copy fills these in when it's migrated, there's nothing to sync
+    conn.execute('''DELETE FROM changelog WHERE seq > ?''', (last_seq,))
+    conn.execute('''CREATE INDEX ingredients_norm_name ON ingredients (norm_name)''')
+    conn.execute('''CREATE INDEX ingredients_content ON ingredients (content_hash, norm_name)''')
+
+
+def _rollup_add(row, sign):
+
+    return f'''INSERT INTO food_rollup (name, entry_day, entries, protein, carbohydrate, fat, kcals)
+               VALUES (coalesce({row}.name, ''), {row}.entry_day, {sign}, {sign} * coalesce({row}.protein, 0),
+               {sign} * coalesce({row}.carbohydrate, 0), {sign} * coalesce({row}.fat, 0),
+               {sign} * coalesce({row}.kcals, 0))
+               ON CONFLICT (name, entry_day) DO UPDATE SET entries = entries + excluded.entries,
+               protein = protein + excluded.protein,
+               carbohydrate = carbohydrate + excluded.carbohydrate,
+               fat = fat + excluded.fat,
+               kcals = kcals + excluded.kcals;
+               DELETE FROM food_rollup WHERE name = coalesce({row}.name, '') AND entry_day = {row}.entry_day
+               AND entries <= 0;'''
+
+
+def m008_food_rollup(conn, role):
+
+    """per-food, per-day sums of the consumption table for statistics about one food or the top foods over a
+    date range (see db.top_foods), and an index for reading one food's entries in time order. The sums are
+    kept by triggers, so entries made by the importer, sync, undo or the dedupe tool are counted the same as
+    ones made in the window. Archived consumption is already summarised per food and day and is read
+    alongside it."""
+
+    if not wanted(role, "food_rollup"):
+        return
+    conn.execute('''CREATE INDEX consumption_name_time ON consumption (name, entry_time)''')
+    conn.execute(ARCHIVE_INDEX.format(schema="main"))
+    conn.execute('''CREATE TABLE food_rollup (
+                    name TEXT NOT NULL,
+                    entry_day INTEGER NOT NULL,
+                    entries INTEGER NOT NULL DEFAULT 0,
+                    protein REAL NOT NULL DEFAULT 0,
+                    carbohydrate REAL NOT NULL DEFAULT 0,
+                    fat REAL NOT NULL DEFAULT 0,
+                    kcals REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (name, entry_day)
+                    ) WITHOUT ROWID''')
+    conn.execute('''CREATE INDEX food_rollup_day ON food_rollup (entry_day)''')
+    conn.execute('''INSERT INTO food_rollup (name, entry_day, entries, protein, carbohydrate, fat, kcals)
+                    SELECT coalesce(name, ''), entry_day, count(*), total(protein), total(carbohydrate), total(fat),
+                    total(kcals) FROM consumption WHERE entry_day IS NOT NULL GROUP BY coalesce(name, ''), entry_day''')
+    conn.execute(f'''CREATE TRIGGER consumption_rollup_insert AFTER INSERT ON consumption BEGIN
+                     {_rollup_add("NEW", 1)}
+                     END''')
+    conn.execute(f'''CREATE TRIGGER consumption_rollup_update
+                     AFTER UPDATE OF name, entry_time, protein, carbohydrate, fat, kcals ON consumption BEGIN
+                     {_rollup_add("OLD", -1)}
+                     {_rollup_add("NEW", 1)}
+                     END''')
+    conn.execute(f'''CREATE TRIGGER consumption_rollup_delete AFTER DELETE ON consumption BEGIN
+                     {_rollup_add("OLD", -1)}
+                     END''')
+
+
+def m009_archived_uuids(conn, role):
+
+    """the uuids of consumption rows that have been archived, so sync can turn away a peer's later change to
+    one of them instead of bringing it back as a live row on a day that is already in the archive"""
+
+    if not wanted(role, "archived_uuids"):
+        return
+    conn.execute('''CREATE TABLE archived_uuids (uuid TEXT PRIMARY KEY) WITHOUT ROWID''')
+
+
+MIGRATIONS = [m001_baseline,
+              m002_typed_columns,
+              m003_daily_totals_and_journal,
+              m004_archive,
+              m005_sync,
+              m006_goals,
+              m007_dedupe_keys,
+              m008_food_rollup,
+              m009_archived_uuids]
+
+
+def migrate(conn, role="all"):
+
+    """apply every migration the database hasn't had yet, each one in its own transaction together with
+    the bump of user_version so a failure leaves the database at the last good version. role is "all",
+    "catalogue" or "profile", see wanted()"""
+
+    if conn.in_transaction:
+        conn.commit()
+    current = conn.execute('''PRAGMA user_version''').fetchone()[0]
+    for version, step in enumerate(MIGRATIONS, start=1):
+        if version <= current:
+            continue
+        conn.execute('''BEGIN''')
+        try:
+            step(conn, role)
+            conn.execute(f'''PRAGMA user_version = {version}''')
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
@@ -0,0 +1,218 @@
+"""works out what to eat for the rest of the day to hit macro and calorie targets. The candidates are every
+recipe (by the portion) and the ingredients eaten most often (by the amount usually logged), and a plan is
+up to MAX_ITEMS of them in multiples of STEP portions.
+
+Each candidate is a row of a matrix of its nutrition per portion, scaled by the targets so that being 10 g
+of protein out counts as much as being 10 g of fat out relative to what was wanted. Every single candidate,
+every pair from a shortlist and every shortlisted third item added to the best pairs is solved as a small
+least squares problem in one go with numpy, and combinations that would need a negative portion are
+thrown away, so there is no per-combination python loop.
+
+PlanSession holds the plan being put together in the window, whether it came from here or was typed in
+with the speculative box ticked, until it is eaten or thrown away."""
+
+import numpy as np
+import db
+
+
+MAX_ITEMS = 3  # most different foods in a plan
+MAX_PORTIONS = 4.0  # most portions of one food
+STEP = 0.25  # portions are rounded to this
+FAVOURITES = 40  # most often eaten ingredients added to the recipes
+SHORTLIST = 150  # candidates that go on to be tried in pairs and triples
+BEST_PAIRS = 60  # pairs that are tried with a third item
+
+# how far out a nutrient can be before it counts as much as missing the target entirely, for targets that
+# are near zero because the day is nearly done
+FLOOR = np.array([10.0, 15.0, 5.0, 100.0])
+
+
+class CandidatePool:
+
+    """the foods a plan can use, with their nutrition for one portion as rows of a matrix in the order
+    of db.NUTRIENTS"""
+
+    def __init__(self, favourites=FAVOURITES, conn=db.CONN):
+
+        self.portions = []  # (name, amount, unit) that make up one portion
+        rows = []
+        for row in conn.execute('''SELECT * FROM recipes''').fetchall():
+            self.portions.append((row["name"], 1.0, "portion"))
+            rows.append([row[k] or 0.0 for k in db.NUTRIENTS])
+
+        # the usual amount is the average per entry, of the unit the food is most often logged in
+        seen = set()
+        for row in conn.execute('''SELECT h.name, h.unit, total(h.amount) / total(h.entries) AS amount,
+                                   total(h.entries) AS n FROM consumption_history h
+                                   JOIN ingredients i ON i.name = h.name
+                                   GROUP BY h.name, h.unit ORDER BY n DESC''').fetchall():
+            if row["name"] in seen or len(seen) >= favourites:
+                continue
+            try:
+                vals = db.calc_nutritional_content((row["name"], row["amount"], row["unit"]), conn)
+            except KeyError:
+                continue  # unit can't be converted any more
+            seen.add(row["name"])
+            self.portions.append((row["name"], row["amount"], row["unit"]))
+            rows.append([vals[k] or 0.0 for k in db.NUTRIENTS])
+
+        self.matrix = np.array(rows, dtype=float).reshape(-1, len(db.NUTRIENTS))
+        keep = self.matrix.any(axis=1)  # a food with no nutrition can't help
+        self.portions = [x for x, k in zip(self.portions, keep) if k]
+        self.matrix = self.matrix[keep]
+
+    def __len__(self):
+
+        return len(self.portions)
+
+
+def _solve(A, t, groups):
+
+    """least squares portions for each group of candidate indices (an array of shape (m, k)), returns the
+    portions (m, k) with NaN rows where the best fit needs a negative portion"""
+
+    sub = A[groups]  # (m, k, nutrients)
+    gram = sub @ sub.transpose(0, 2, 1)
+    rhs = sub @ t
+    x = np.full(groups.shape, np.nan)
+    ok = np.abs(np.linalg.det(gram)) > 1e-12  # two foods with proportional nutrition have no single answer
+    if ok.any():
+        x[ok] = np.linalg.solve(gram[ok], rhs[ok][..., None])[..., 0]
+    x[(x < 0).any(axis=1)] = np.nan
+    return np.minimum(x, MAX_PORTIONS)
+
+
+def _errors(A, t, groups, x):
+
+    return (((A[groups] * x[..., None]).sum(axis=1) - t) ** 2).sum(axis=1)
+
+
+def plan(targets, pool, top=5):
+
+    """targets is {nutrient: amount still wanted today}, nutrients that are left out don't count.
+    Returns up to top plans, best first, as dicts of items [(name, amount, unit)], the nutrition of each
+    item, totals and error, the sum over the nutrients of the squared miss as a fraction of the target, so
+    0 is spot on and eating nothing scores about 1 per nutrient."""
+
+    n = len(pool)
+    if n == 0:
+        return []
+    weight = np.array([1.0 if targets.get(k) is not None else 0.0 for k in db.NUTRIENTS])
+    want = np.array([max(float(targets.get(k) or 0.0), 0.0) for k in db.NUTRIENTS])
+    scale = weight / np.maximum(want, FLOOR)
+    A = pool.matrix * scale
+    t = want * scale
+
+    found = []  # (groups, portions) for each size of plan
+
+    singles = np.arange(n)[:, None]
+    found.append((singles, _solve(A, t, singles)))
+    single_err = np.where(np.isnan(found[0][1][:, 0]), np.inf, _errors(A, t, singles, np.nan_to_num(found[0][1])))
+
+    # the shortlist is the best foods on their own plus the richest in each nutrient, since something
+    # that's nearly all protein can be a poor plan by itself but the best partner for a starchy one
+    per_kcal = pool.matrix / np.maximum(pool.matrix[:, [3]], 1.0)
+    picks = [np.argsort(single_err)[:SHORTLIST // 2]]
+    picks += [np.argsort(-per_kcal[:, i])[:SHORTLIST // 8] for i in range(3)]
+    short = np.unique(np.concatenate(picks))
+
+    if MAX_ITEMS >= 2 and len(short) >= 2:
+        i, j = np.triu_indices(len(short), k=1)
+        pairs = np.stack([short[i], short[j]], axis=1)
+        x = _solve(A, t, pairs)
+        good = ~np.isnan(x[:, 0])
+        pairs, x = pairs[good], x[good]
+        found.append((pairs, x))
+
+        if MAX_ITEMS >= 3 and len(pairs):
+            best = pairs[np.argsort(_errors(A, t, pairs, x))[:BEST_PAIRS]]
+            triples = np.concatenate([np.repeat(best, len(short), axis=0),
+                                      np.tile(short, len(best))[:, None]], axis=1)
+            triples = triples[(triples[:, 2] != triples[:, 0]) & (triples[:, 2] != triples[:, 1])]
+            x = _solve(A, t, triples)
+            good = ~np.isnan(x[:, 0])
+            found.append((triples[good], x[good]))
+
+    # real portions, then score them again since rounding moves the totals
+    plans = []
+    for groups, x in found:
+        x = np.round(np.nan_to_num(x) / STEP) * STEP
+        err = _errors(A, t, groups, x)
+        for row in np.argsort(err)[:top * 4]:
+            plans.append((err[row], groups[row], x[row]))
+    plans.sort(key=lambda p: p[0])
+
+    out = []
+    seen = set()
+    for err, group, x in plans:
+        items = tuple(sorted((int(g), float(p)) for g, p in zip(group, x) if p > 0))
+        if not items or items in seen:
+            continue
+        seen.add(items)
+        totals = sum(pool.matrix[g] * p for g, p in items)
+        out.append({"items": [(pool.portions[g][0], round(pool.portions[g][1] * p, 2), pool.portions[g][2])
+                              for g, p in items],
+                    "nutrition": [pool.matrix[g] * p for g, p in items],
+                    "totals": {k: float(v) for k, v in zip(db.NUTRIENTS, totals)},
+                    "error": float(err)})
+        if len(out) == top:
+            break
+    return out
+
+
+class PlanSession:
+
+    """speculative entries kept in memory until they are eaten or thrown away. Each item's nutrition is
+    worked out once when it's added and the session keeps the running sum, so adding or removing an item
+    doesn't touch the database and costs the same however long the plan is."""
+
+    def __init__(self):
+
+        self.items = {}  # item id: ((name, amount, unit), nutrition array in the order of db.NUTRIENTS)
+        self.sum = np.zeros(len(db.NUTRIENTS))
+        self.next_id = 0
+
+    def __len__(self):
+
+        return len(self.items)
+
+    def add(self, tup, nutrition=None, conn=db.CONN):
+
+        """add (name, amount, unit), looking its nutrition up unless it's given (e.g. from a plan).
+        Returns the item's id for remove()"""
+
+        if nutrition is None:
+            info = db.calc_nutritional_content(tup, conn)
+            nutrition = [info[k] for k in db.NUTRIENTS]
+        vec = np.array(nutrition, dtype=float)
+        self.next_id += 1
+        self.items[self.next_id] = (tup, vec)
+        self.sum += vec
+        return self.next_id
+
+    def remove(self, item_id):
+
+        tup, vec = self.items.pop(item_id)
+        self.sum -= vec
+        return tup
+
+    def clear(self):
+
+        self.items = {}
+        self.sum = np.zeros(len(db.NUTRIENTS))
+
+    def totals(self):
+
+        return {k: float(v) for k, v in zip(db.NUTRIENTS, self.sum)}
+
+    def commit(self, conn=db.CONN):
+
+        """record every item as eaten in one transaction, the listeners hear about them together once it
+        has committed. Returns the number of entries made."""
+
+        tups = [tup for tup, _ in self.items.values()]
+        with db.batch(conn):
+            for tup in tups:
+                db.record_consumption(tup, conn)
+        self.clear()
+        return len(tups)
@@ -0,0 +1,99 @@
+"""set up separate profiles that share one catalogue of ingredients and recipes, e.g.
+
+    python profiles.py init alice      # split db.sqlite3 into catalogue.sqlite3 and profiles/alice.sqlite3
+    python profiles.py add bob         # a new, empty profile
+    python profiles.py list
+
+Once catalogue.sqlite3 exists the app opens it and attaches one profile (see db.connect), the window
+has a menu to switch between them. db.sqlite3 itself is left alone by init, so it can be kept as a backup
+or deleted."""
+
+import argparse
+import os
+import sqlite3
+import migrations
+
+
+LEGACY_PATH = "db.sqlite3"
+
+
+def _split_copy(src, path, role):
+
+    """copy the old single database and drop the tables that belong in the other kind of file, so the
+    rows keep their ids and uuids"""
+
+    out = sqlite3.connect(path)
+    src.backup(out)
+    drop = migrations.PROFILE_TABLES if role == "catalogue" else migrations.CATALOGUE_TABLES
+    for table in drop:
+        out.execute(f'''DROP TABLE IF EXISTS {table}''')  # takes its indexes and sync triggers with it
+    out.execute(f'''DELETE FROM changelog WHERE tbl IN ({", ".join("?" * len(drop))})''', drop)
+    if role == "catalogue":
+        out.execute('''DELETE FROM settings WHERE key = ?''', ("archive_path",))
+    else:
+        # a site id of its own, so another copy keeps track of syncing the profile apart from the catalogue
+        out.execute('''UPDATE settings SET value = lower(hex(randomblob(16))) WHERE key = ?''', ("site_id",))
+    out.commit()
+    out.execute('''VACUUM''')
+    out.close()
+
+
+def init(name, catalogue_path, profile_dir):
+
+    """turn db.sqlite3 into a catalogue plus a first profile called name"""
+
+    if os.path.exists(catalogue_path):
+        raise FileExistsError(f"{catalogue_path} already exists")
+    src = sqlite3.connect(LEGACY_PATH)
+    migrations.migrate(src)  # both halves need to start from the current schema
+    os.makedirs(profile_dir, exist_ok=True)
+    profile = os.path.join(profile_dir, f"{name}.sqlite3")
+    if os.path.exists(profile):
+        raise FileExistsError(f"{profile} already exists")
+    _split_copy(src, profile, "profile")
+    _split_copy(src, catalogue_path, "catalogue")
+    src.close()
+
+
+def add(name, profile_dir):
+
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, f"{name}.sqlite3")
+    if os.path.exists(path):
+        raise FileExistsError(f"{path} already exists")
+    conn = sqlite3.connect(path)
+    migrations.migrate(conn, "profile")
+    conn.close()
+
+
+def main():
+
+    # importing db connects to the database, which in profile mode needs a profile to exist already, so
+    # the paths are repeated here rather than imported
+    parser = argparse.ArgumentParser(description="manage profiles that share one ingredient catalogue")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("init", help="split db.sqlite3 into a shared catalogue and a first profile")
+    p.add_argument("name")
+    p = sub.add_parser("add", help="make a new empty profile")
+    p.add_argument("name")
+    sub.add_parser("list", help="list the profiles")
+    args = parser.parse_args()
+
+    catalogue_path, profile_dir = "catalogue.sqlite3", "profiles"
+    if args.command == "init":
+        init(args.name, catalogue_path, profile_dir)
+        print(f"made {catalogue_path} and profile {args.name} from {LEGACY_PATH}")
+    elif args.command == "add":
+        if not os.path.exists(catalogue_path):
+            raise SystemExit(f"run 'profiles.py init NAME' first to make {catalogue_path}")
+        add(args.name, profile_dir)
+        print(f"made profile {args.name}")
+    else:
+        names = []
+        if os.path.isdir(profile_dir):
+            names = [x[:-len(".sqlite3")] for x in sorted(os.listdir(profile_dir)) if x.endswith(".sqlite3")]
+        print("\n".join(names) if names else "no profiles")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,7 @@
-DROP TABLE IF EXISTS ingredients;
-DROP TABLE IF EXISTS recipes;
-DROP TABLE IF EXISTS consumption;
-DROP TABLE IF EXISTS weight;
+-- original layout of the database, this is migration 1 in migrations.py and every later change to the
+-- schema is made by a numbered migration on top of it
 
-CREATE TABLE ingredients (
+CREATE TABLE IF NOT EXISTS ingredients (
 id INTEGER PRIMARY KEY AUTOINCREMENT,
 name TEXT UNIQUE NOT NULL,
 protein REAL,
@@ -15,7 +13,7 @@ serving_size TEXT,
 container_name TEXT
 );
 
-CREATE TABLE recipes (
+CREATE TABLE IF NOT EXISTS recipes (
 id INTEGER PRIMARY KEY AUTOINCREMENT,
 name TEXT,
 composition_string TEXT,
@@ -25,7 +23,7 @@ fat REAL,
 kcals REAL
 );
 
-CREATE TABLE consumption (
+CREATE TABLE IF NOT EXISTS consumption (
 id INTEGER PRIMARY KEY AUTOINCREMENT,
 name TEXT,
 amount REAL,
@@ -37,8 +35,8 @@ kcals REAL,
 entry_time NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE TABLE weight (
+CREATE TABLE IF NOT EXISTS weight (
 id INTEGER PRIMARY KEY AUTOINCREMENT,
 weighin REAL,
 entry_time NOT NULL DEFAULT CURRENT_TIMESTAMP
-)
\ No newline at end of file
+);
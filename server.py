@@ -0,0 +1,246 @@
+"""optional HTTP/JSON server so food can be logged from another device on the local network without using
+the desktop window, e.g.
+
+    python server.py --host 0.0.0.0 --port 8321
+    python server.py --profile alice    # with profiles, see profiles.py
+
+    POST /consumption   {"name": "egg", "amount": 2, "unit": "each"}
+    POST /weight        {"weight": 70.4}
+    GET  /ingredients?q=chick&limit=20
+    GET  /totals?date=2024-05-01    (or date=now, the default)
+
+All writes go through one writer task, which takes whatever requests have queued up while the previous
+batch was being written and commits them together in one transaction. Reads are served from a small pool
+of separate connections so they don't wait behind the writes."""
+
+import argparse
+import asyncio
+import json
+import sqlite3
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import db
+
+
+MAX_BATCH = 256  # most write requests committed in one transaction
+BUSY_TIMEOUT = 5000  # ms a connection waits for a lock before giving up with "database is locked"
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, msg):
+
+        super().__init__(msg)
+        self.status = status
+
+
+def record_consumption(conn, body):
+
+    tup = (str(body["name"]).lower(), body["amount"], body["unit"])
+    return db.record_consumption(tup, conn)
+
+
+def enter_weight(conn, body):
+
+    change = db.enter_weight(float(body["weight"]), conn)
+    return change["after"]
+
+
+def search_ingredients(conn, query):
+
+    return db.search_ingredients(query.get("q", ""), int(query.get("limit", 50)), conn)
+
+
+def daily_totals(conn, query):
+
+    row = db.get_daily_totals(date=query.get("date", "now"), conn=conn)[0]
+    return {k: row[f"sum({k})"] for k in db.NUTRIENTS}
+
+
+WRITES = {"/consumption": record_consumption, "/weight": enter_weight}
+READS = {"/ingredients": search_ingredients, "/totals": daily_totals}
+
+
+class Server:
+
+    def __init__(self, path=None, readers=4, profile=None):
+
+        """path is a database file to serve on its own, otherwise the app's database (and with profiles,
+        the given profile or whoever used the app last)"""
+
+        self.path = path
+        self.profile = profile
+        self.writes = None  # asyncio.Queue of (function, body, future), made once the loop is running
+        self.write_executor = ThreadPoolExecutor(max_workers=1)  # the writer connection lives on this thread
+        self.write_conn = None
+        self.read_executor = ThreadPoolExecutor(max_workers=readers)
+        self.readers = readers
+        self.read_pool = None
+        self.wal = False  # set once the database files have been switched to write-ahead logging
+
+    def connect(self, check_same_thread=True):
+
+        """a connection that waits for locks rather than failing on them. The first one also puts every
+        file it has open into WAL mode, which stays set in the file, so readers see the last commit while a
+        batch is being written instead of being locked out by it"""
+
+        if self.path:
+            conn = db.get_db_connection(self.path, check_same_thread)
+        else:
+            conn = db.connect(self.profile, check_same_thread)
+        conn.execute(f'''PRAGMA busy_timeout = {BUSY_TIMEOUT}''')
+        if not self.wal:
+            for row in conn.execute('''PRAGMA database_list''').fetchall():
+                if row["name"] != "temp":
+                    conn.execute(f'''PRAGMA {row["name"]}.journal_mode = WAL''')
+            self.wal = True
+        return conn
+
+    async def start(self, host, port):
+
+        loop = asyncio.get_running_loop()
+        self.writes = asyncio.Queue()
+        self.write_conn = await loop.run_in_executor(self.write_executor, self.connect)
+        self.read_pool = asyncio.Queue()
+        for _ in range(self.readers):
+            self.read_pool.put_nowait(self.connect(check_same_thread=False))
+        asyncio.create_task(self.writer())
+        return await asyncio.start_server(self.handle_client, host, port)
+
+    async def writer(self):
+
+        """take every write that is waiting, commit them as one batch, reply to each, repeat"""
+
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.writes.get()]
+            while not self.writes.empty() and len(batch) < MAX_BATCH:
+                batch.append(self.writes.get_nowait())
+            try:
+                results = await loop.run_in_executor(self.write_executor, self.write_batch, batch)
+            except Exception as e:
+                # the whole transaction failed, so none of the writes happened
+                results = [(False, HTTPError(500, str(e)))] * len(batch)
+            for (_, _, fut), (ok, result) in zip(batch, results):
+                if fut.done():
+                    continue
+                if ok:
+                    fut.set_result(result)
+                else:
+                    fut.set_exception(result)
+
+    def write_batch(self, batch):
+
+        """runs on the writer thread. Each request gets a savepoint so a bad one is rolled back on its own
+        without losing the rest of the batch"""
+
+        conn = self.write_conn
+        results = []
+        with db.batch(conn):
+            for func, body, _ in batch:
+                conn.execute('''SAVEPOINT request''')
+                try:
+                    results.append((True, func(conn, body)))
+                except (KeyError, TypeError, ValueError, sqlite3.IntegrityError) as e:
+                    conn.execute('''ROLLBACK TO request''')
+                    results.append((False, HTTPError(400, f"{type(e).__name__}: {e}")))
+                conn.execute('''RELEASE request''')
+        return results
+
+    async def read(self, func, query):
+
+        conn = await self.read_pool.get()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.read_executor, func, conn, query)
+        finally:
+            self.read_pool.put_nowait(conn)
+
+    async def dispatch(self, method, target, body):
+
+        url = urllib.parse.urlsplit(target)
+        if url.path in WRITES:
+            if method != "POST":
+                raise HTTPError(405, "use POST")
+            try:
+                data = json.loads(body or b"{}")
+            except ValueError:
+                raise HTTPError(400, "body is not JSON")
+            fut = asyncio.get_running_loop().create_future()
+            await self.writes.put((WRITES[url.path], data, fut))
+            return await fut
+        if url.path in READS:
+            if method != "GET":
+                raise HTTPError(405, "use GET")
+            query = dict(urllib.parse.parse_qsl(url.query))
+            try:
+                return await self.read(READS[url.path], query)
+            except (KeyError, TypeError, ValueError) as e:
+                raise HTTPError(400, f"{type(e).__name__}: {e}")
+        raise HTTPError(404, f"nothing at {url.path}")
+
+    async def handle_client(self, reader, writer):
+
+        """minimal HTTP/1.1, one request at a time per connection, kept alive unless the client asks
+        to close it"""
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    k, _, v = line.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                length = int(headers.get("content-length", 0))
+                body = await reader.readexactly(length) if length else b""
+
+                try:
+                    status, payload = 200, await self.dispatch(method, target, body)
+                except HTTPError as e:
+                    status, payload = e.status, {"error": str(e)}
+                except Exception as e:
+                    status, payload = 500, {"error": str(e)}
+
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                out = json.dumps(payload).encode()
+                writer.write(f"HTTP/1.1 {status} {STATUS[status]}\r\n"
+                             f"Content-Type: application/json\r\n"
+                             f"Content-Length: {len(out)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + out)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # client went away or sent something that isn't HTTP
+        finally:
+            writer.close()
+
+
+async def serve(host, port, path, readers, profile):
+
+    server = await Server(path, readers, profile).start(host, port)
+    print(f"listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="HTTP/JSON API for logging food from other devices")
+    parser.add_argument("--host", default="127.0.0.1", help="use 0.0.0.0 to accept connections from the LAN")
+    parser.add_argument("--port", type=int, default=8321)
+    parser.add_argument("--db", default=None, help="database file, instead of the one the app uses")
+    parser.add_argument("--profile", default=None, help="profile to log to, when there are profiles")
+    parser.add_argument("--readers", type=int, default=4, help="connections in the read pool")
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.db, args.readers, args.profile))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""sync two copies of the database by swapping only what changed since they last synced, e.g.
+
+    python sync.py id                                   # print this database's site id
+    python sync.py new-id                               # once, on a copy made by copying the file
+    python sync.py export changes.json --peer SITE_ID   # changes the other copy hasn't had yet
+    python sync.py import changes.json
+    python sync.py serve --port 8322                    # on one machine
+    python sync.py connect otherhost --port 8322        # on the other, both sides end up with everything
+
+Every row of the synced tables has a uuid and every insert, update and delete is recorded in the changelog
+(see migrations.m005_sync), so an exchange reads the changelog from where the last one stopped rather than
+comparing whole tables. When both copies changed the same row, the change with the later timestamp wins,
+ties going to the higher site id, so both sides settle on the same row whichever order the changes
+arrive in.
+
+With profiles (see profiles.py) the catalogue and each profile are separate files, each synced on its own:
+
+    python sync.py --db catalogue.sqlite3 connect otherhost
+    python sync.py --db profiles/alice.sqlite3 connect otherhost"""
+
+import argparse
+import json
+import socket
+import db
+import migrations
+
+
+def site_id(conn=db.CONN):
+
+    return conn.execute('''SELECT value FROM settings WHERE key = ?''', ("site_id",)).fetchone()[0]
+
+
+def new_site_id(conn=db.CONN):
+
+    """give this file a site id of its own, for a copy of a database file made by copying the file rather
+    than starting a new one. The changes it made under the old id are restamped with the new one so they
+    still get sent to the copy it was made from. Some of them came from there in the first place and go
+    back unchanged, which is harmless. Returns the new id."""
+
+    old = site_id(conn)
+    new = conn.execute('''SELECT lower(hex(randomblob(16)))''').fetchone()[0]
+    conn.execute('''UPDATE settings SET value = ? WHERE key = ?''', (new, "site_id"))
+    conn.execute('''UPDATE changelog SET origin = ? WHERE origin = ?''', (new, old))
+    conn.commit()
+    return new
+
+
+def _check_peer(peer, conn):
+
+    if peer == site_id(conn):
+        raise ValueError("the other copy has the same site id as this one, it was probably copied from this "
+                         "file. Run 'sync.py new-id' on one of them first.")
+
+
+def _row_values(table, uuid, conn):
+
+    """the columns that travel with a change, the local id and generated columns stay behind"""
+
+    row = conn.execute(f'''SELECT * FROM {table} WHERE uuid = ?''', (uuid,)).fetchone()
+    if row is None:
+        return None
+    return {k: row[k] for k in row.keys() if k not in ("id", "entry_day")}
+
+
+def export_changes(peer=None, conn=db.CONN):
+
+    """changes made here that the peer isn't known to have applied yet (everything, for a peer that hasn't
+    been seen before), leaving out the ones that came from the peer in the first place. Only the latest change
+    to each row is sent, along with the row as it is now."""
+
+    since = 0
+    received = 0
+    if peer:
+        _check_peer(peer, conn)
+        row = conn.execute('''SELECT sent_seq, received_seq FROM sync_peers WHERE site_id = ?''', (peer,)).fetchone()
+        since = row["sent_seq"] if row else 0
+        received = row["received_seq"] if row else 0
+    rows = conn.execute('''SELECT c.* FROM changelog c
+                           JOIN (SELECT max(seq) AS seq FROM changelog WHERE seq > ? GROUP BY tbl, uuid) latest
+                           ON c.seq = latest.seq
+                           WHERE c.origin != ? ORDER BY c.seq''', (since, peer or "")).fetchall()
+    upto = conn.execute('''SELECT coalesce(max(seq), 0) FROM changelog''').fetchone()[0]
+
+    changes = []
+    for c in rows:
+        values = _row_values(c["tbl"], c["uuid"], conn) if c["op"] == "upsert" else None
+        changes.append({"tbl": c["tbl"], "uuid": c["uuid"], "op": c["op"] if values else "delete",
+                        "ts": c["ts"], "origin": c["origin"], "row": values})
+    # how far we've applied the peer's changes, so it knows what has arrived even when changes go by file
+    return {"site": site_id(conn), "since": since, "upto": upto, "received": received, "changes": changes}
+
+
+def mark_sent(peer, upto, conn=db.CONN):
+
+    conn.execute('''INSERT INTO sync_peers (site_id, sent_seq) VALUES (?, ?)
+                    ON CONFLICT(site_id) DO UPDATE SET sent_seq = max(sent_seq, excluded.sent_seq)''', (peer, upto))
+    conn.commit()
+
+
+def _latest(table, uuid, conn):
+
+    return conn.execute('''SELECT ts, origin FROM changelog WHERE tbl = ? AND uuid = ?
+                           ORDER BY seq DESC LIMIT 1''', (table, uuid)).fetchone()
+
+
+def _apply_one(change, conn):
+
+    """apply one remote change if it beats what we have. Returns the entry_days of consumption it touched."""
+
+    table = change["tbl"]
+    if table not in migrations.SYNCED_TABLES:
+        raise ValueError(f"can't sync table {table}")
+    if not conn.execute('''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?''', (table,)).fetchone():
+        return set()  # a catalogue or profile file only takes its own half of a change set from a whole database
+    uuid = change["uuid"]
+    if table == "consumption" and conn.execute('''SELECT 1 FROM archived_uuids WHERE uuid = ?''',
+                                               (uuid,)).fetchone():
+        return set()  # archived here, it's already counted in the day's summary
+    local = _latest(table, uuid, conn)
+    if local and (local["ts"], local["origin"]) >= (change["ts"], change["origin"]):
+        return set()  # ours is newer, the peer will take ours when it imports from us
+
+    days = set()
+    old = conn.execute(f'''SELECT * FROM {table} WHERE uuid = ?''', (uuid,)).fetchone()
+    if old is not None and table == "consumption":
+        days.add(old["entry_day"])
+
+    if change["op"] == "delete":
+        conn.execute(f'''DELETE FROM {table} WHERE uuid = ?''', (uuid,))
+    else:
+        values = dict(change["row"])
+        if old is None and table == "ingredients":
+            # the same ingredient added separately on both machines, both copies keep the lower uuid
+            clash = conn.execute('''SELECT uuid FROM ingredients WHERE name = ?''', (values["name"],)).fetchone()
+            if clash is not None:
+                if clash["uuid"] < uuid:
+                    return set()
+                conn.execute('''UPDATE ingredients SET uuid = ? WHERE uuid = ?''', (uuid, clash["uuid"]))
+                old = clash
+        cols = list(values.keys())
+        if old is None:
+            conn.execute(f'''INSERT INTO {table} ({", ".join(cols)}) VALUES ({", ".join("?" * len(cols))})''',
+                         tuple(values[k] for k in cols))
+        else:
+            conn.execute(f'''UPDATE {table} SET {", ".join(f"{k} = ?" for k in cols)} WHERE uuid = ?''',
+                         tuple(values[k] for k in cols) + (uuid,))
+        if table == "ingredients":
+            db._UNIT_FACTORS.pop(values["name"], None)
+        if table == "consumption":
+            days.add(conn.execute('''SELECT entry_day FROM consumption WHERE uuid = ?''', (uuid,)).fetchone()[0])
+    return days
+
+
+def import_changes(data, conn=db.CONN):
+
+    """apply a set of changes from export_changes() on the other copy in one transaction. Returns the
+    number of changes that were applied rather than beaten by a newer local change."""
+
+    peer = data["site"]
+    _check_peer(peer, conn)
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('''BEGIN''')
+    try:
+        applied = 0
+        days = set()
+        for change in data["changes"]:
+            before = conn.execute('''SELECT coalesce(max(seq), 0) FROM changelog''').fetchone()[0]
+            touched = _apply_one(change, conn)
+            after = conn.execute('''SELECT coalesce(max(seq), 0) FROM changelog''').fetchone()[0]
+            if after > before:
+                applied += 1
+                days |= touched
+                # the triggers logged this as a local change, it keeps the time and origin it had on the peer
+                # so it isn't sent back there and compares the same way on both sides
+                conn.execute('''UPDATE changelog SET ts = ?, origin = ? WHERE seq > ?''',
+                             (change["ts"], change["origin"], before))
+        days.discard(None)
+        if days:
+            db.rebuild_daily_totals(days, conn)
+        conn.execute('''INSERT INTO sync_peers (site_id, received_seq) VALUES (?, ?)
+                        ON CONFLICT(site_id) DO UPDATE SET received_seq = max(received_seq, excluded.received_seq)''',
+                     (peer, data["upto"]))
+        # our changes up to what the peer says it has applied don't need sending to it again
+        conn.execute('''UPDATE sync_peers SET sent_seq = max(sent_seq, ?) WHERE site_id = ?''',
+                     (data.get("received", 0), peer))
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return applied
+
+
+def _send(sock, obj):
+
+    sock.sendall(json.dumps(obj).encode() + b"\n")
+
+
+def _receive(f):
+
+    line = f.readline()
+    if not line:
+        raise ConnectionError("the other side closed the connection")
+    return json.loads(line)
+
+
+def exchange(sock, conn=db.CONN):
+
+    """both ends of a socket sync run this: swap site ids, send our changes, apply theirs"""
+
+    f = sock.makefile("rb")
+    _send(sock, {"site": site_id(conn)})
+    peer = _receive(f)["site"]
+    _check_peer(peer, conn)  # the other side finds the same and closes the connection too
+    data = export_changes(peer, conn)
+    _send(sock, data)
+    applied = import_changes(_receive(f), conn)
+    _send(sock, {"ok": True})
+    _receive(f)  # only mark our changes sent once the other side has applied them
+    mark_sent(peer, data["upto"], conn)
+    return len(data["changes"]), applied
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="sync this database with another copy of it")
+    parser.add_argument("--db", default=None, help="database file, needed when there are profiles")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("id", help="print this database's site id")
+    sub.add_parser("new-id", help="give a copied database file a site id of its own")
+    p = sub.add_parser("export", help="write changes to a file")
+    p.add_argument("path")
+    p.add_argument("--peer", default=None, help="site id of the copy the file is for")
+    p = sub.add_parser("import", help="apply changes from a file")
+    p.add_argument("path")
+    p = sub.add_parser("serve", help="wait for the other copy to connect")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8322)
+    p = sub.add_parser("connect", help="sync with a copy that is serving")
+    p.add_argument("host")
+    p.add_argument("--port", type=int, default=8322)
+    args = parser.parse_args()
+
+    if args.db:
+        conn = db.get_db_connection(args.db)
+    elif db.current_profile(db.CONN) is None:
+        conn = db.CONN
+    else:
+        # the app's connection has two files attached and each has its own changelog
+        parser.error(f"choose --db {db.CATALOGUE_PATH} or --db {db.profile_path(db.current_profile(db.CONN))}")
+
+    try:
+        _run(args, conn)
+    except ValueError as e:
+        raise SystemExit(f"sync failed: {e}")
+
+
+def _run(args, conn):
+
+    if args.command == "id":
+        print(site_id(conn))
+    elif args.command == "new-id":
+        print(f"site id changed from {site_id(conn)} to {new_site_id(conn)}")
+    elif args.command == "export":
+        data = export_changes(args.peer, conn)
+        with open(args.path, "w") as f:
+            json.dump(data, f)
+        # not marked as sent until a file or connection from the peer says they were applied, so a lost
+        # file doesn't lose the changes
+        print(f"wrote {len(data['changes'])} changes to {args.path}")
+    elif args.command == "import":
+        with open(args.path, "r") as f:
+            data = json.load(f)
+        print(f"applied {import_changes(data, conn)} of {len(data['changes'])} changes")
+    elif args.command == "serve":
+        with socket.create_server((args.host, args.port)) as server:
+            print(f"waiting on {args.host}:{args.port}")
+            sock, addr = server.accept()
+            with sock:
+                sent, applied = exchange(sock, conn)
+        print(f"sent {sent} changes to {addr[0]}, applied {applied}")
+    else:
+        with socket.create_connection((args.host, args.port)) as sock:
+            sent, applied = exchange(sock, conn)
+        print(f"sent {sent} changes, applied {applied}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""replays a script of typing, tab completion, logging entries and clicking graph points in the real window
+against made-up databases of different sizes, and times each step, e.g.
+
+    python uireplay.py --sizes 1000 10000 100000
+    python uireplay.py --sizes 20000 --script steps.json --repeat 5 --json results.json
+
+A script is a JSON list of steps like DEFAULT_SCRIPT below. For each step two times are recorded: the
+handler, which is the event handler itself (te_function, te_tab_down, add_entry, or the graph's pick
+handler and show_pie_charts for a click), and the render, which is the root.update() after it where the
+DayState flush, the queued matplotlib redraws and Tk's own redraw happen. Typing also records the
+filter that runs once typing pauses. Keyboard steps call the bound handler with an event just like
+the one Tk would pass, which doesn't depend on which window has the keyboard focus. Clicks are real
+Tk mouse events on the graph canvas, so matplotlib's picking is part of the time.
+
+It needs an X display. Without one it starts Xvfb, which has to be installed. Each database size runs
+in a fresh process because db opens its database when it is imported."""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+DEFAULT_SCRIPT = [
+    {"do": "type", "text": "chick"},
+    {"do": "backspace", "count": 2},
+    {"do": "type", "text": "ic"},
+    {"do": "arrow", "key": "down", "count": 3},
+    {"do": "tab"},
+    {"do": "amount", "text": "150"},
+    {"do": "enter"},
+    {"do": "type", "text": "rice"},
+    {"do": "tab"},
+    {"do": "amount", "text": "80"},
+    {"do": "enter"},
+    {"do": "click", "point": -1},
+    {"do": "click", "point": 0},
+    {"do": "pie", "date": "now"},
+]
+
+FOODS = ["chicken", "rice", "oats", "egg", "beans", "bread", "milk", "apple", "banana", "pasta", "cheese",
+         "yoghurt", "lentils", "salmon", "potato", "tofu", "spinach", "peanut butter", "almonds", "beef"]
+STYLES = ["plain", "baked", "raw", "smoked", "organic", "tinned", "frozen", "dried", "roasted", "fresh"]
+DAYS = 365  # of made-up history
+ENTRIES_PER_DAY = 8
+KEYCODES = {"backspace": 8, "tab": 9, "up": 38, "down": 40}  # the codes MyEntryBoxes checks for
+
+
+def build_database(size, days=DAYS, seed=0):
+
+    """fill the (empty) database db opened with size ingredients, a twentieth as many recipes and a
+    year of consumption and weigh-ins"""
+
+    import db
+    import units
+
+    rng = random.Random(seed)
+    conn = db.CONN
+    ingredients = []
+    for i in range(size):
+        p, c, f = rng.uniform(0, 30), rng.uniform(0, 80), rng.uniform(0, 30)
+        ingredients.append((f"{rng.choice(FOODS)} {rng.choice(STYLES)} {i}", p, c, f, 4 * p + 4 * c + 9 * f, "g",
+                            units.own_factor("g"), units.container_factor("g", None)))
+    recipes = []
+    for i in range(max(1, size // 20)):
+        p, c, f = rng.uniform(5, 40), rng.uniform(10, 90), rng.uniform(5, 40)
+        recipes.append((f"{rng.choice(FOODS)} {rng.choice(STYLES)} bake {i}", "", p, c, f, 4 * p + 4 * c + 9 * f))
+
+    today = datetime.datetime.combine(datetime.datetime.now(datetime.timezone.utc).date(), datetime.time())
+    consumption = []
+    weights = []
+    for d in range(1, days + 1):
+        day = today - datetime.timedelta(days=d)
+        for _ in range(ENTRIES_PER_DAY):
+            name, p, c, f, k = rng.choice(ingredients)[:5]
+            amount = rng.choice([50, 80, 100, 150, 200])
+            when = day + datetime.timedelta(minutes=rng.randrange(24 * 60))
+            consumption.append((name, amount, "g", p * amount / 100, c * amount / 100, f * amount / 100,
+                                k * amount / 100, when.strftime("%Y-%m-%d %H:%M:%S")))
+        weigh_time = day + datetime.timedelta(hours=7)
+        weights.append((round(rng.gauss(75, 2), 1), weigh_time.strftime("%Y-%m-%d %H:%M:%S")))
+
+    with db.batch(conn):
+        conn.executemany('''INSERT INTO ingredients (name, protein, carbohydrate, fat, kcals, unit, unit_factor,
+                            container_factor) VALUES (?,?,?,?,?,?,?,?)''', ingredients)
+        conn.executemany('''INSERT INTO recipes (name, composition_string, protein, carbohydrate, fat, kcals)
+                            VALUES (?,?,?,?,?,?)''', recipes)
+        conn.executemany('''INSERT INTO consumption (name, amount, unit, protein, carbohydrate, fat, kcals, entry_time)
+                            VALUES (?,?,?,?,?,?,?,?)''', consumption)
+        conn.executemany('''INSERT INTO weight (weighin, entry_time) VALUES (?,?)''', weights)
+        db.rebuild_daily_totals(conn=conn)
+
+
+class Replay:
+
+    """drives one window through a script and collects the timings"""
+
+    def __init__(self, root):
+
+        self.root = root
+        self.app = root.app
+        self.boxes = root.app.entry_boxes
+        self.errors = []
+        root.report_callback_exception = self.on_error  # errors inside Tk callbacks don't reach us otherwise
+
+    def on_error(self, kind, value, tb):
+
+        self.errors.append(f"{kind.__name__}: {value}")
+
+    def event(self, widget, key=None):
+
+        import tkinter
+        e = tkinter.Event()
+        e.widget = widget
+        e.keycode = KEYCODES.get(key, 0)
+        e.keysym = key or ""
+        return e
+
+    def timed(self, func, *args):
+
+        start = time.perf_counter()
+        func(*args)
+        return (time.perf_counter() - start) * 1000
+
+    def step(self, step):
+
+        """run one step, returns {"handler": ms, "render": ms} and "filter": ms for typing"""
+
+        do = step["do"]
+        entry = self.boxes.name_entry
+        out = {"handler": 0.0}
+        if do in ("type", "backspace"):
+            keys = step["text"] if do == "type" else [None] * step.get("count", 1)
+            for ch in keys:
+                if ch is None:
+                    entry.delete(len(entry.get()) - 1, "end")
+                else:
+                    entry.insert("end", ch)
+                e = self.event(entry, "backspace" if ch is None else ch)
+                out["handler"] += self.timed(self.boxes.te_function, e)
+            out["filter"] = self.timed(self.boxes.flush)  # what runs once typing pauses
+        elif do == "arrow":
+            for _ in range(step.get("count", 1)):
+                out["handler"] += self.timed(self.boxes.te_arrow, self.event(entry, step["key"]))
+        elif do == "tab":
+            out["handler"] = self.timed(self.boxes.te_tab_down, self.event(entry, "tab"))
+        elif do == "amount":
+            self.boxes.amount_entry.delete(0, "end")
+            self.boxes.amount_entry.insert(0, step["text"])
+        elif do == "enter":
+            out["handler"] = self.timed(self.app.add_entry, self.event(self.boxes.unit_entry, "Return"))
+        elif do == "click":
+            out["handler"] = self.timed(self.click_point, step.get("point", -1))
+        elif do == "pie":
+            out["handler"] = self.timed(self.root.show_pie_charts, step.get("date", "now"))
+        else:
+            raise ValueError(f"unknown step {do}")
+        out["render"] = self.timed(self.root.update)
+        return out
+
+    def click_point(self, index):
+
+        """press and release the left button over one point of the calorie line"""
+
+        import matplotlib.dates as mdates
+        graph = self.app.graph_window.line_graph
+        if not graph.xdata:
+            return
+        x, y = graph.xdata[index], graph.caldata[index]
+        px, py = graph.ax2.transData.transform((mdates.date2num(x), y))
+        ratio = getattr(graph.canvas, "device_pixel_ratio", 1) or 1
+        widget = graph.canvas.get_tk_widget()
+        tx, ty = int(px / ratio), int(widget.winfo_height() - py / ratio)  # Tk counts y from the top
+        widget.event_generate("<ButtonPress-1>", x=tx, y=ty)
+        widget.event_generate("<ButtonRelease-1>", x=tx, y=ty)
+
+
+def run_child(size, script, repeat):
+
+    """runs in the process for one database size, the database is already pointed at by CALORIE_DB"""
+
+    start = time.perf_counter()
+    build_database(size)
+    built = time.perf_counter() - start
+
+    import main
+    start = time.perf_counter()
+    root = main.MyRoot()
+    root.update()
+    opened = time.perf_counter() - start
+
+    replay = Replay(root)
+    results = []  # (step number, description, timings)
+    for _ in range(repeat):
+        for i, step in enumerate(script):
+            try:
+                timings = replay.step(step)
+            except Exception as e:
+                replay.errors.append(f"step {i} {step}: {type(e).__name__}: {e}")
+                continue
+            results.append((i, json.dumps(step), timings))
+    root.destroy()
+    return {"size": size, "build_s": built, "startup_ms": opened * 1000, "steps": results, "errors": replay.errors}
+
+
+def start_xvfb():
+
+    """start a virtual X server on a free display, returns (process, display)"""
+
+    n = 99
+    while os.path.exists(f"/tmp/.X{n}-lock"):
+        n += 1
+    try:
+        proc = subprocess.Popen(["Xvfb", f":{n}", "-screen", "0", "1920x1080x24", "-nolisten", "tcp"],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        raise SystemExit("no DISPLAY and Xvfb isn't installed")
+    for _ in range(100):
+        if os.path.exists(f"/tmp/.X11-unix/X{n}"):
+            return proc, f":{n}"
+        time.sleep(0.1)
+    proc.terminate()
+    raise SystemExit("Xvfb didn't start")
+
+
+def summarise(result):
+
+    """median and worst time of each step over the repeats"""
+
+    by_step = {}
+    for i, desc, timings in result["steps"]:
+        by_step.setdefault((i, desc), []).append(timings)
+    rows = []
+    for (i, desc), runs in sorted(by_step.items()):
+        row = {"step": i, "desc": desc}
+        for k in ("handler", "filter", "render"):
+            vals = [t[k] for t in runs if k in t]
+            if vals:
+                row[k] = {"median": statistics.median(vals), "max": max(vals)}
+        rows.append(row)
+    return rows
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="time the window's event handlers against made-up databases")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="numbers of ingredients")
+    parser.add_argument("--script", default=None, help="JSON list of steps, see DEFAULT_SCRIPT")
+    parser.add_argument("--repeat", type=int, default=3, help="times to run the script in each window")
+    parser.add_argument("--json", default=None, help="also write the full results to this file")
+    parser.add_argument("--child", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    script = DEFAULT_SCRIPT
+    if args.script:
+        with open(args.script, "r") as f:
+            script = json.load(f)
+
+    if args.child is not None:
+        print(json.dumps(run_child(args.child, script, args.repeat)))
+        return
+
+    xvfb = None
+    env = dict(os.environ)
+    if not env.get("DISPLAY"):
+        xvfb, env["DISPLAY"] = start_xvfb()
+    results = []
+    failed = []  # sizes where a step of the script raised
+    try:
+        for size in args.sizes:
+            with tempfile.TemporaryDirectory() as tmp:
+                env["CALORIE_DB"] = os.path.join(tmp, "replay.sqlite3")
+                cmd = [sys.executable, os.path.abspath(__file__), "--child", str(size), "--repeat", str(args.repeat)]
+                if args.script:
+                    cmd += ["--script", os.path.abspath(args.script)]
+                proc = subprocess.run(cmd, env=env, capture_output=True, text=True,
+                                      cwd=os.path.dirname(os.path.abspath(__file__)))
+                if proc.returncode != 0:
+                    print(proc.stderr, file=sys.stderr)
+                    raise SystemExit(f"replay with {size} ingredients failed")
+                result = json.loads(proc.stdout.strip().splitlines()[-1])
+            result["summary"] = summarise(result)
+            results.append(result)
+
+            print(f"\n{size} ingredients: database built in {result['build_s']:.1f} s, "
+                  f"window opened in {result['startup_ms']:.0f} ms")
+            print(f"    {'step':<52} {'handler ms':>14} {'filter ms':>14} {'render ms':>14}")
+            for row in result["summary"]:
+                cells = [f"{row[k]['median']:6.1f} /{row[k]['max']:6.1f}" if k in row else "" for k in
+                         ("handler", "filter", "render")]
+                print(f"    {row['desc'][:52]:<52} {cells[0]:>14} {cells[1]:>14} {cells[2]:>14}")
+            for err in result["errors"][:5]:
+                print(f"    error: {err}")
+            if result["errors"]:
+                failed.append(size)
+        print("\n(times are median / worst over the repeats)")
+    finally:
+        if xvfb:
+            xvfb.terminate()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+    if failed:
+        # a step that raised is missing from the timings, so the numbers above aren't comparable
+        raise SystemExit(f"steps failed with {', '.join(map(str, failed))} ingredients")
+
+
+if __name__ == "__main__":
+    main()
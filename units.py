@@ -0,0 +1,120 @@
+"""unit graph used to turn an (amount, unit) pair into a multiplier for an ingredient's nutritional values.
+Nutritional info is stored per 100 g/mL, or per item for things measured in "each". Every unit that makes
+sense for an ingredient is resolved to a single factor when the ingredient is first looked up, so the
+calculation itself is just amount * factor * value."""
+
+# conversion to the base unit of each dimension
+MASS = {"g": 1.0, "mg": 0.001, "kg": 1000.0, "oz": 28.349523125, "lb": 453.59237}
+VOLUME = {"ml": 1.0, "l": 1000.0, "cup": 236.5882365, "tbsp": 14.78676478125, "tsp": 4.92892159375,
+          "fl oz": 29.5735295625}
+COUNT = {"each": 1.0}
+
+ALIASES = {
+    "gram": "g", "grams": "g", "gm": "g", "gms": "g",
+    "milligram": "mg", "milligrams": "mg",
+    "kilogram": "kg", "kilograms": "kg", "kilo": "kg", "kilos": "kg",
+    "ounce": "oz", "ounces": "oz",
+    "pound": "lb", "pounds": "lb", "lbs": "lb",
+    "millilitre": "ml", "millilitres": "ml", "milliliter": "ml", "milliliters": "ml",
+    "litre": "l", "litres": "l", "liter": "l", "liters": "l",
+    "cups": "cup",
+    "tablespoon": "tbsp", "tablespoons": "tbsp",
+    "teaspoon": "tsp", "teaspoons": "tsp",
+    "floz": "fl oz", "fluid ounce": "fl oz", "fluid ounces": "fl oz",
+    "item": "each", "items": "each", "x": "each",
+}
+
+DIMENSIONS = {"mass": MASS, "volume": VOLUME, "count": COUNT}
+
+
+def normalise(unit):
+
+    """lower case and strip a unit string and map any alias onto the canonical name"""
+
+    if unit is None:
+        return None
+    u = " ".join(str(unit).lower().split())
+    return ALIASES.get(u, u)
+
+
+def dimension_of(unit):
+
+    """returns (dimension name, size in the dimension's base unit) or None if the unit is unknown"""
+
+    u = normalise(unit)
+    for dim, table in DIMENSIONS.items():
+        if u in table:
+            return dim, table[u]
+    return None
+
+
+def _spellings(canonical):
+
+    """every string that normalises to the canonical unit name, so the factor table can be keyed on all of
+    them and looking a unit up never needs to normalise it first"""
+
+    return [canonical] + [a for a, c in ALIASES.items() if c == canonical]
+
+
+def own_factor(unit):
+
+    """factor for one of the ingredient's own unit, nutritional info is per item for "each" and per 100
+    of anything else"""
+
+    base = dimension_of(unit)
+    if base and base[0] == "count":
+        return 1.0
+    return 0.01
+
+
+def container_factor(unit, serving_size):
+
+    """factor for one whole container, serving size is the container's content in the ingredient's own unit"""
+
+    if serving_size in (None, ""):
+        return None
+    return float(serving_size) * own_factor(unit)
+
+
+def build_factors(unit, serving_size=None, container_name=None, density=None, unit_factor=None, cont_factor=None):
+
+    """given an ingredient's own unit, container size and (optionally) density in g/mL, return a dict
+    of {unit: factor} where nutritional value = stored value * amount * factor. The factors for the own unit
+    and the container can be passed in if they have already been worked out when the ingredient was stored."""
+
+    base = dimension_of(unit)
+    if base is None:
+        # something the graph doesn't know about, it can still be entered in its own unit
+        base_dim, base_size = None, 1.0
+    else:
+        base_dim, base_size = base
+
+    own = unit_factor if unit_factor is not None else own_factor(unit)
+
+    factors = {}
+    if base_dim in ("mass", "volume"):
+        for dim, table in (("mass", MASS), ("volume", VOLUME)):
+            if dim == base_dim:
+                scale = 1.0
+            elif density:
+                # grams per mL converts between the two, in the right direction for the base unit
+                scale = float(density) if base_dim == "mass" else 1.0 / float(density)
+            else:
+                continue
+            for u, size in table.items():
+                for s in _spellings(u):
+                    factors[s] = size * scale / base_size * own
+    elif base_dim == "count":
+        for s in _spellings("each"):
+            factors[s] = 1.0
+
+    if unit:
+        factors[unit] = own
+        factors[normalise(unit)] = own
+
+    cont = cont_factor if cont_factor is not None else container_factor(unit, serving_size)
+    if container_name and cont is not None:
+        factors[container_name] = cont
+        factors[normalise(container_name)] = cont
+
+    return factors